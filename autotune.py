@@ -2,177 +2,583 @@
 
 import asyncio
 import sys
-import threading
-import time
 import json
 import shutil
+import signal
 from datetime import datetime
-from bleak import BleakClient, BleakError
+from typing import NamedTuple, Tuple
+from bleak import BleakError
+from desk_control import (DEFAULT_KEEPALIVE_S, DEFAULT_SETTLE_QUIET_S, MotionScheduler, drive_until, keepalive,
+                          pulse, wait_for_height, wait_for_settle)
+from desk_dispatch import CommandDispatcher
+from desk_model import DEFAULT_FILTER_PARAMS, CoastPredictor, HeightFilter, MotorModel
+from desk_protocol import FrameReassembler, HeightFrame
+from desk_scan import characteristic, create_bleak_client, describe_connect
+from desk_telemetry import HeightRing, RecordingClient, now_ns, open_recorder
+from desk_sim import SimulatedBleakClient, run_async, simulator_enabled
+from desk_ui import DEFAULT_MAX_FPS, TerminalRenderer, run_renderer
 import numpy as np
 
 # --- Configuration File Name ---
 CONFIG_FILENAME = "config.json"
 
-# --- ANSI Escape Codes ---
-CURSOR_UP_N = lambda n: f"\033[{n}F"
-CLEAR_LINE = "\033[K"
+# --- Coast Test ---
+START_MARGIN_MM = 50            # Each test starts this far before the setpoint
+
+# --- Overshoot Table Sweep ---
+DEFAULT_TABLE_SETPOINTS = 4
+# Tests start START_MARGIN_MM past the setpoint and may coast a little further.
+TABLE_EDGE_MARGIN_MM = 60
+
+# --- Early Stopping ---
+DEFAULT_AUTOTUNE_PARAMS = {
+    "min_tests": 3,             # Per direction and setpoint, before the interval is trusted
+    "max_tests": 8,             # Give up on converging after this many
+    "ci_width_mm": 2.0,         # Stop once the 95% confidence interval is this narrow
+    "outlier_z": 3.5,           # Robust z-score above which a test is dropped as an outlier
+    # System identification (autotune.py sysid)
+    "step_s": 3.0,              # How long each step holds the move command
+    "steps": 2,                 # Step responses per direction
+    "pulses_s": [0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 0.8],
+    "pulse_repeats": 2,         # Per pulse length and direction; the median is kept
+    "trace_poll_s": 0.025,      # Ask for a height report this often while tracing, 0 = off
+    # Keepalive interval (autotune.py keepalive)
+    "keepalive_candidates_s": [0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5],
+    "keepalive_hold_s": 2.0,    # Each candidate holds a move this long; speed is measured over the second half
+}
+# Two-sided 95% Student t quantiles for 1..30 degrees of freedom.
+T_95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+# Heights are reported in whole mm, so the spread is never trusted below half of that.
+MIN_MAD_MM = 0.5
+
+
+class CoastStats(NamedTuple):
+    """Statistics over the coast distances of one direction at one setpoint."""
+    tests: int
+    mean_mm: float
+    var_mm2: float
+    ci_width_mm: float                  # Full width of the 95% interval for the mean
+    outliers: Tuple[float, ...]         # Dropped before computing the above
+
+
+def coast_stats(samples, outlier_z: float = DEFAULT_AUTOTUNE_PARAMS["outlier_z"]) -> CoastStats:
+    """Drops outliers by their median absolute deviation, then estimates the mean and its interval."""
+    x = np.asarray(samples, dtype=float)
+    median = np.median(x)
+    mad = max(float(np.median(np.abs(x - median))), MIN_MAD_MM)
+    is_outlier = 0.6745 * np.abs(x - median) / mad > outlier_z
+    kept = x[~is_outlier]
+    n = len(kept)
+    var = float(np.var(kept, ddof=1)) if n > 1 else float("inf")
+    t = T_95[min(n - 1, len(T_95)) - 1] if n > 1 else float("inf")
+    width = 2 * t * np.sqrt(var / n) if n > 1 else float("inf")
+    return CoastStats(len(x), float(np.mean(kept)), var, float(width), tuple(x[is_outlier].tolist()))
+
+
+def autotune_params(config: dict) -> dict:
+    params = dict(DEFAULT_AUTOTUNE_PARAMS)
+    params.update(config.get("autotune", {}))
+    return params
 
 class DeskContext:
-    """Thread safe class to hold shared state."""
+    """Shared state for the BLE and UI tasks, which all run on one event loop."""
     def __init__(self):
-        self.current_mm = 0
         self.status = "Initializing..."
-        self.lock = threading.Lock()
-        self.quit_event = threading.Event()
-        self.height_is_known_event = threading.Event()
+        self.version = 0
+        self.reassembler = FrameReassembler()
+        self.heights = HeightRing()
+        self.motion = HeightFilter(self.heights)
+        self.changed = asyncio.Event()
+        self.quit_event = asyncio.Event()
+        self.height_is_known_event = asyncio.Event()
+        self.height_changed = asyncio.Event()
+        self.recorder = None        # TelemetryRecorder when recording is enabled
+
+    def _touch(self):
+        self.version += 1
+        self.changed.set()
 
     def set_status(self, new_status):
-        with self.lock: self.status = new_status
-
-    def set_height(self, new_height_mm):
-        with self.lock:
-            is_first_update = (self.current_mm == 0)
-            self.current_mm = new_height_mm
-            if is_first_update and new_height_mm != 0:
-                self.height_is_known_event.set()
+        self.status = new_status
+        if self.recorder is not None:
+            self.recorder.status(new_status)
+        self._touch()
+
+    @property
+    def current_mm(self):
+        return self.heights.latest_mm
+
+    @property
+    def filtered_mm(self):
+        return self.motion.position_mm()
+
+    def add_height(self, t_ns, height_mm):
+        """Records one height sample; wakes the renderer if the height changed."""
+        changed = height_mm != self.heights.latest_mm
+        self.heights.append(t_ns, height_mm)
+        if changed:
+            self._touch()
 
     def get_data(self):
-        with self.lock: return self.status, self.current_mm / 10.0
+        return self.status, self.filtered_mm / 10.0
             
     def should_quit(self):
         return self.quit_event.is_set()
 
+    def request_quit(self, status=None):
+        if status:
+            self.set_status(status)
+        self.quit_event.set()
+        self.height_changed.set()   # Wakes anything waiting on the desk
+        self._touch()
+
 # -----------------------------------------------------------------
 # BLUETOOTH LOGIC
 # -----------------------------------------------------------------
 
 def notification_handler(sender, data: bytearray, context: DeskContext):
-    hex_data = data.hex()
     try:
-        index = hex_data.index("f2f20103")
-        height_hex = hex_data[index + 8 : index + 12]
-        new_height_mm = int(height_hex, 16)
-        if new_height_mm != context.current_mm:
-            is_first_update = (context.current_mm == 0)
-            context.set_height(new_height_mm)
-            if is_first_update and new_height_mm != 0:
-                context.height_is_known_event.set()
-    except ValueError: pass
+        for frame in context.reassembler.feed(data):
+            if not isinstance(frame, HeightFrame): continue
+            new_height_mm = frame.height_mm
+            previous_mm = context.current_mm
+            context.add_height(now_ns(), new_height_mm)
+            if new_height_mm != previous_mm:
+                context.height_changed.set()
+                if previous_mm == 0 and new_height_mm != 0:
+                    context.height_is_known_event.set()
     except Exception as e: context.set_status(f"Parse Error: {e}")
 
-async def wait_for_settle(duration_s, context):
-    """Wait for a duration, checking for quit signal."""
-    start = time.time()
-    while time.time() - start < duration_s:
-        if context.should_quit():
-            return False
-        await asyncio.sleep(0.1)
-    return True
-
-async def move_to_start_pos(client, context, write_uuid, cmd, target_mm, is_moving_up):
+async def move_to_start_pos(motor: MotionScheduler, context, cmd, target_mm, is_moving_up):
     """Moves desk to the starting position before a test."""
     if is_moving_up:
-        while context.current_mm < target_mm and not context.should_quit():
-            await client.write_gatt_char(write_uuid, cmd, response=False)
-            await asyncio.sleep(0.1)
+        await drive_until(motor, context, cmd, lambda mm: mm >= target_mm)
     else:
-        while context.current_mm > target_mm and not context.should_quit():
-            await client.write_gatt_char(write_uuid, cmd, response=False)
-            await asyncio.sleep(0.1)
+        await drive_until(motor, context, cmd, lambda mm: mm <= target_mm)
     
-    await client.write_gatt_char(write_uuid, cmd, response=False) 
+    await motor.write(cmd)
 
-async def run_overshoot_test(client: BleakClient, context: DeskContext, config: dict, commands: dict, setpoint_mm):
+async def measure_coast(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict,
+                        setpoint_mm, direction, label=""):
     """
-    Directly measures coasting distance for UP and DOWN.
+    Repeats the coast test in one direction until the interval for its mean is
+    narrow enough. Returns (CoastStats, mean deceleration or None), or None if cancelled.
+    """
+    up = direction == "UP"
+    cmd_toward = commands["move_up"] if up else commands["move_down"]
+    cmd_away = commands["move_down"] if up else commands["move_up"]
+    sign = 1 if up else -1
+    predictor = CoastPredictor(direction, config["tuning_params"])
+    params = autotune_params(config)
+    settle_quiet_s = config["tuning_params"].get("settle_quiet_s", DEFAULT_SETTLE_QUIET_S)
+
+    # Start below the setpoint for UP, above it for DOWN
+    start_pos_mm = setpoint_mm - sign * START_MARGIN_MM
+    overshoots = []
+    decels = []
+    stats = None
+    for i in range(params["max_tests"]):
+        if context.should_quit(): return None
+        test = f"{label}{direction} Test {i+1}"
+
+        # Go to start position, approaching it in the test direction
+        context.set_status(f"{test}: Moving to start pos ({start_pos_mm/10.0} cm)...")
+        await move_to_start_pos(motor, context, cmd_away, start_pos_mm + sign * 5, not up)
+        await wait_for_settle(context, settle_quiet_s, 1.5)
+        await move_to_start_pos(motor, context, cmd_toward, start_pos_mm, up)
+        await motor.stop()
+        if not await wait_for_settle(context, settle_quiet_s, 1.5): return None
+
+        # Start test
+        context.set_status(f"{test}: Moving {direction} to {setpoint_mm/10.0} cm...")
+        if up:
+            await drive_until(motor, context, cmd_toward, lambda mm: mm >= setpoint_mm)
+        else:
+            await drive_until(motor, context, cmd_toward, lambda mm: mm <= setpoint_mm)
+
+        # Stop exactly at the setpoint
+        await motor.stop()
+        stop_height_mm, stop_speed_mm_s = context.filtered_mm, sign * context.motion.velocity()
+        context.set_status(f"{test}: Stopped. Measuring coast...")
+        if not await wait_for_settle(context, settle_quiet_s, 2.0): return None # Wait for coast
+
+        overshoot = sign * (context.filtered_mm - setpoint_mm)
+        overshoots.append(overshoot)
+        decel = predictor.decel_from_stop(stop_speed_mm_s, sign * (context.filtered_mm - stop_height_mm))
+        if decel: decels.append(decel)
+
+        stats = coast_stats(overshoots, params["outlier_z"])
+        context.set_status(f"{test}: Coasted {overshoot:.1f} mm (mean {stats.mean_mm:.1f}, CI {stats.ci_width_mm:.1f} mm)")
+        if i + 1 >= params["min_tests"] and stats.ci_width_mm <= params["ci_width_mm"]:
+            break
+
+    return stats, (float(np.mean(decels)) if decels else None)
+
+async def run_overshoot_test(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict, setpoint_mm, label=""):
+    """
+    Directly measures coasting distance for UP and DOWN at one setpoint.
+    label prefixes the status lines, e.g. "[2/4] " during a table sweep.
+    Returns (stats_up, stats_down, decel_up, decel_down), or None if cancelled.
     """
-    write_uuid = config["write_uuid"]
-    cmd_up = commands["move_up"]
-    cmd_down = commands["move_down"]
-    cmd_stop = commands["stop"]
-    
-    overshoots_up = []
-    overshoots_down = []
-    
-    # Autotune parameters
-    NUM_TESTS = 3
-    START_MARGIN_MM = 50 
-
     try:
-        # --- TEST MOVING UP ---
-        for i in range(NUM_TESTS):
-            if context.should_quit(): return None
-            
-            # Go to start position (below setpoint)
-            start_pos_mm = setpoint_mm - START_MARGIN_MM
-            context.set_status(f"UP Test {i+1}/{NUM_TESTS}: Moving to start pos ({start_pos_mm/10.0} cm)...")
-            await move_to_start_pos(client, context, write_uuid, cmd_down, start_pos_mm + 5, False)
-            await wait_for_settle(1.5, context)
-            await move_to_start_pos(client, context, write_uuid, cmd_up, start_pos_mm, True)
-            await client.write_gatt_char(write_uuid, cmd_stop, response=False)
-            if not await wait_for_settle(1.5, context): return None
-
-            # Start test
-            context.set_status(f"UP Test {i+1}/{NUM_TESTS}: Moving UP to {setpoint_mm/10.0} cm...")
-            while context.current_mm < setpoint_mm and not context.should_quit():
-                await client.write_gatt_char(write_uuid, cmd_up, response=False)
-                await asyncio.sleep(0.1)
-            
-            # Stop exactly at the setpoint
-            await client.write_gatt_char(write_uuid, cmd_stop, response=False)
-            context.set_status(f"UP Test {i+1}/{NUM_TESTS}: Stopped. Measuring coast...")
-            if not await wait_for_settle(2.0, context): return None # Wait for coast
-            
-            overshoot = context.current_mm - setpoint_mm
-            overshoots_up.append(overshoot)
-            context.set_status(f"UP Test {i+1}/{NUM_TESTS}: Coasted {overshoot} mm")
-            await asyncio.sleep(1.0)
-
-        # --- TEST MOVING DOWN ---
-        for i in range(NUM_TESTS):
-            if context.should_quit(): return None
-
-            # Go to start position (above setpoint)
-            start_pos_mm = setpoint_mm + START_MARGIN_MM
-            context.set_status(f"DOWN Test {i+1}/{NUM_TESTS}: Moving to start pos ({start_pos_mm/10.0} cm)...")
-            await move_to_start_pos(client, context, write_uuid, cmd_up, start_pos_mm - 5, True)
-            await wait_for_settle(1.5, context)
-            await move_to_start_pos(client, context, write_uuid, cmd_down, start_pos_mm, False)
-            await client.write_gatt_char(write_uuid, cmd_stop, response=False)
-            if not await wait_for_settle(1.5, context): return None
-            
-            # Start test
-            context.set_status(f"DOWN Test {i+1}/{NUM_TESTS}: Moving DOWN to {setpoint_mm/10.0} cm...")
-            while context.current_mm > setpoint_mm and not context.should_quit():
-                await client.write_gatt_char(write_uuid, cmd_down, response=False)
-                await asyncio.sleep(0.1)
-
-            # Stop exactly at the setpoint
-            await client.write_gatt_char(write_uuid, cmd_stop, response=False)
-            context.set_status(f"DOWN Test {i+1}/{NUM_TESTS}: Stopped. Measuring coast...")
-            if not await wait_for_settle(2.0, context): return None
-
-            overshoot = setpoint_mm - context.current_mm
-            overshoots_down.append(overshoot)
-            context.set_status(f"DOWN Test {i+1}/{NUM_TESTS}: Coasted {overshoot} mm")
-            await asyncio.sleep(1.0)
-        
-        # --- CALCULATE RESULTS ---
-        avg_overshoot_up = sum(overshoots_up) / len(overshoots_up)
-        avg_overshoot_down = sum(overshoots_down) / len(overshoots_down)
-        
-        context.set_status("Autotune Complete.")
-        return (avg_overshoot_up, avg_overshoot_down)
+        up = await measure_coast(motor, context, config, commands, setpoint_mm, "UP", label)
+        if up is None: return None
+        down = await measure_coast(motor, context, config, commands, setpoint_mm, "DOWN", label)
+        if down is None: return None
+        return (up[0], down[0], up[1], down[1])
 
     except Exception as e:
         context.set_status(f"Error in test: {e}")
         return None
     finally:
-        await client.write_gatt_char(write_uuid, cmd_stop, response=False)
-        context.quit_event.set()
+        await motor.stop()
+
+async def run_sweep(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict, setpoints_mm):
+    """Returns [(setpoint_mm, stats_up, stats_down, decel_up, decel_down), ...], or None if cancelled."""
+    results = []
+    for i, setpoint_mm in enumerate(setpoints_mm):
+        label = f"[{i + 1}/{len(setpoints_mm)}] " if len(setpoints_mm) > 1 else ""
+        result = await run_overshoot_test(motor, context, config, commands, setpoint_mm, label)
+        if result is None:
+            return None
+        results.append((setpoint_mm,) + result)
+    return results
+
+# -----------------------------------------------------------------
+# KEEPALIVE INTERVAL
+# -----------------------------------------------------------------
+
+# An interval passes if the desk keeps this fraction of the speed it reaches with the first candidate.
+KEEPALIVE_MIN_SPEED_RATIO = 0.95
+# The saved keepalive_s is this fraction of the longest interval that passed.
+KEEPALIVE_SAFETY = 0.75
+
+async def hold_speed(motor: MotionScheduler, context: DeskContext, cmd, hold_s):
+    """Holds cmd for hold_s, then stops. Returns the mean speed (mm/s) over the second half."""
+    motor.start(cmd)
+    try:
+        await asyncio.sleep(hold_s / 2)
+        t0_ns, h0_mm = context.heights.latest()
+        await asyncio.sleep(hold_s / 2)
+        t1_ns, h1_mm = context.heights.latest()
+    finally:
+        await motor.release()
+    await motor.stop()
+    return abs(h1_mm - h0_mm) / ((t1_ns - t0_ns) / 1e9) if t1_ns > t0_ns else 0.0
 
-async def async_ble_main(context: DeskContext, config: dict, commands: dict, setpoint_mm):
+async def measure_keepalive(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict):
+    """
+    Holds a move UP and back DOWN with every candidate refresh interval,
+    longest last, until the desk no longer keeps its speed. Returns
+    [(interval_s, speed_up, speed_down), ...], or None if cancelled.
+    """
+    params = autotune_params(config)
+    settle_quiet_s = config["tuning_params"].get("settle_quiet_s", DEFAULT_SETTLE_QUIET_S)
+    low_mm = int(round(config["height_limits"]["min_cm"] * 10)) + TABLE_EDGE_MARGIN_MM
+    configured_s = motor.interval_s
+    rows = []
+    try:
+        context.set_status(f"Keepalive: Moving to start pos ({low_mm/10.0} cm)...")
+        if context.current_mm > low_mm:
+            await move_to_start_pos(motor, context, commands["move_down"], low_mm, False)
+        else:
+            await move_to_start_pos(motor, context, commands["move_up"], low_mm, True)
+        await motor.stop()
+        if not await wait_for_settle(context, settle_quiet_s, 2.0): return None
+
+        for interval_s in sorted(params["keepalive_candidates_s"]):
+            motor.interval_s = interval_s
+            speeds = []
+            for direction in ("UP", "DOWN"):
+                if context.should_quit(): return None
+                context.set_status(f"Keepalive {interval_s * 1000:.0f}ms: Holding {direction}...")
+                cmd = commands["move_up"] if direction == "UP" else commands["move_down"]
+                speeds.append(await hold_speed(motor, context, cmd, params["keepalive_hold_s"]))
+                if not await wait_for_settle(context, settle_quiet_s, 2.0): return None
+            rows.append((interval_s, speeds[0], speeds[1]))
+            context.set_status(f"Keepalive {interval_s * 1000:.0f}ms: {speeds[0]:.1f} / {speeds[1]:.1f} mm/s")
+            _, base_up, base_down = rows[0]
+            if min(speeds[0] / base_up, speeds[1] / base_down) < KEEPALIVE_MIN_SPEED_RATIO:
+                break
+    except ZeroDivisionError:
+        context.set_status("Error: The desk did not move with the shortest interval.")
+        return None
+    finally:
+        motor.interval_s = configured_s
+        await motor.stop()
+    return rows
+
+# -----------------------------------------------------------------
+# SYSTEM IDENTIFICATION
+# -----------------------------------------------------------------
+
+# The cruise speed is fitted over the last part of each step, before stop.
+CRUISE_WINDOW_S = 1.0
+MAX_STOP_DEAD_TIME_S = 0.5
+FIT_GRID = 200
+
+class SmoothedTrace(NamedTuple):
+    position_mm: np.ndarray
+    velocity_mm_s: np.ndarray
+    position_sd_mm: np.ndarray
+
+def smooth_trace(t_s, height_mm, filter_params=None) -> SmoothedTrace:
+    """
+    Batch version of the controller's HeightFilter for a whole recorded
+    trace: the same constant-acceleration Kalman filter run forward, then a
+    Rauch-Tung-Striebel pass backward, so every sample is estimated from
+    the samples after it as well. Once the reading has not changed for
+    max_gap_s the desk is held at rest, and the next change starts a new
+    segment from there, as HeightFilter does.
+    """
+    params = dict(DEFAULT_FILTER_PARAMS)
+    params.update(filter_params or {})
+    t = np.asarray(t_s, dtype=float)
+    z = np.asarray(height_mm, dtype=float)
+    n = len(t)
+    r = params["noise_mm"] ** 2
+    p_rest = np.diag([r, params["initial_speed_sd"] ** 2, params["initial_accel_sd"] ** 2])
+    x_pred, p_pred = np.zeros((n, 3)), np.zeros((n, 3, 3))
+    x_filt, p_filt = np.zeros((n, 3)), np.zeros((n, 3, 3))
+    f_all = np.zeros((n, 3, 3))
+    restart = np.zeros(n, dtype=bool)     # No link to the sample before (for the backward pass)
+
+    changed_s = t[0] if n else 0.0
+    for i in range(n):
+        resting = i > 0 and t[i] - changed_s > params["max_gap_s"]
+        if i > 0 and z[i] != z[i - 1]:
+            changed_s = t[i]
+        elif resting:
+            restart[i] = True
+            x_filt[i], p_filt[i] = (z[i], 0.0, 0.0), p_rest
+            x_pred[i], p_pred[i] = x_filt[i], p_filt[i]
+            continue
+        if i == 0 or resting:
+            restart[i] = True
+            x_pred[i], p_pred[i] = (z[i - 1] if i else z[0], 0.0, 0.0), p_rest
+        else:
+            dt = t[i] - t[i - 1]
+            f = np.array([[1.0, dt, dt * dt / 2], [0.0, 1.0, dt], [0.0, 0.0, 1.0]])
+            q = params["jerk_psd"] * np.array([[dt ** 5 / 20, dt ** 4 / 8, dt ** 3 / 6],
+                                               [dt ** 4 / 8, dt ** 3 / 3, dt ** 2 / 2],
+                                               [dt ** 3 / 6, dt ** 2 / 2, dt]])
+            f_all[i] = f
+            x_pred[i] = f @ x_filt[i - 1]
+            p_pred[i] = f @ p_filt[i - 1] @ f.T + q
+        gain = p_pred[i][:, 0] / (p_pred[i][0, 0] + r)
+        x_filt[i] = x_pred[i] + gain * (z[i] - x_pred[i][0])
+        p_filt[i] = p_pred[i] - np.outer(gain, p_pred[i][0])
+
+    x_smooth, p_smooth = x_filt.copy(), p_filt.copy()
+    for i in range(n - 2, -1, -1):
+        if restart[i + 1]:
+            continue
+        c = p_filt[i] @ f_all[i + 1].T @ np.linalg.inv(p_pred[i + 1])
+        x_smooth[i] = x_filt[i] + c @ (x_smooth[i + 1] - x_pred[i + 1])
+        p_smooth[i] = p_filt[i] + c @ (p_smooth[i + 1] - p_pred[i + 1]) @ c.T
+    return SmoothedTrace(x_smooth[:, 0], x_smooth[:, 1], np.sqrt(np.clip(p_smooth[:, 0, 0], 0.0, None)))
+
+def step_model(t, stop_s, p: dict):
+    """Travel (mm) at times t (s) for a move command at 0 and stop at stop_s, as MotorModel models it."""
+    t = np.asarray(t, dtype=float)
+    accel, cruise, decel = p["accel_mm_s2"], p["cruise_mm_s"], p["decel_mm_s2"]
+    powered_s = max(0.0, stop_s + p["stop_dead_time_s"] - p["start_dead_time_s"])
+    ramp_s = cruise / accel
+    end_speed = min(cruise, accel * powered_s)
+    moving = np.clip(t - p["start_dead_time_s"], 0.0, None)
+    driving = np.minimum(moving, powered_s)
+    driven = np.where(driving < ramp_s, 0.5 * accel * driving ** 2, cruise * (driving - 0.5 * ramp_s))
+    braking = np.clip(moving - powered_s, 0.0, end_speed / decel)
+    return driven + end_speed * braking - 0.5 * decel * braking ** 2
+
+def fit_step(t_s, travel_mm, stop_s) -> dict:
+    """
+    Fits the MotorModel parameters to one step response by least squares:
+    a straight line through the cruise phase gives the cruise speed, then
+    the start and stop dead times are searched on a grid, with the
+    acceleration and deceleration that go with each candidate in closed form.
+    """
+    t = np.asarray(t_s, dtype=float)
+    x = np.asarray(travel_mm, dtype=float)
+    # The resting level, from every sample of the settled tail rather than the last few.
+    final_mm = float(smooth_trace(t, x).position_mm[-1])
+
+    # Cruise: x = cruise * t + offset
+    cruise_from = stop_s - min(CRUISE_WINDOW_S, stop_s / 2)
+    in_cruise = (t >= cruise_from) & (t <= stop_s)
+    if in_cruise.sum() < 3:
+        raise ValueError("Too few samples in the cruise phase; use a longer step_s.")
+    (cruise, offset), *_ = np.linalg.lstsq(np.column_stack([t[in_cruise], np.ones(in_cruise.sum())]),
+                                          x[in_cruise], rcond=None)
+    if cruise <= 0:
+        raise ValueError("The desk did not move during the step.")
+
+    # Start: the cruise line crosses zero travel at dead + cruise / (2 * accel)
+    t_cross = max(-offset / cruise, 1e-3)
+    ramp = t < cruise_from
+    dead = np.linspace(0.0, 0.95 * t_cross, FIT_GRID)[:, None]
+    accel = cruise / (2 * (t_cross - dead))
+    moving = np.clip(t[ramp] - dead, 0.0, None)
+    ramp_s = cruise / accel
+    model = np.where(moving < ramp_s, 0.5 * accel * moving ** 2, cruise * (moving - 0.5 * ramp_s))
+    best = int(np.argmin(((model - x[ramp]) ** 2).sum(axis=1)))
+    start_dead, accel = float(dead[best, 0]), float(accel[best, 0])
+
+    # Stop: the coast is cruise * stop_dead + cruise^2 / (2 * decel)
+    stop_mm = cruise * stop_s + offset
+    coast_mm = final_mm - stop_mm
+    if coast_mm <= 0:
+        raise ValueError("The desk did not coast after stop.")
+    after = t[t > stop_s] - stop_s
+    stop_dead = np.linspace(0.0, min(0.95 * coast_mm / cruise, MAX_STOP_DEAD_TIME_S), FIT_GRID)[:, None]
+    decel = cruise ** 2 / (2 * (coast_mm - cruise * stop_dead))
+    braking = np.clip(after - stop_dead, 0.0, cruise / decel)
+    model = stop_mm + cruise * np.minimum(after, stop_dead) + cruise * braking - 0.5 * decel * braking ** 2
+    best = int(np.argmin(((model - x[t > stop_s]) ** 2).sum(axis=1)))
+
+    params = {
+        "start_dead_time_s": start_dead,
+        "accel_mm_s2": accel,
+        "cruise_mm_s": float(cruise),
+        "stop_dead_time_s": float(stop_dead[best, 0]),
+        "decel_mm_s2": float(decel[best, 0]),
+    }
+    params["rms_mm"] = float(np.sqrt(np.mean((step_model(t, stop_s, params) - x) ** 2)))
+    return params
+
+def fit_pulses(pulses_s, travel_mm):
+    """Least-squares line travel = mm_per_s * pulse + offset_mm over the measured pulses."""
+    A = np.column_stack([np.asarray(pulses_s, dtype=float), np.ones(len(pulses_s))])
+    (mm_per_s, offset_mm), *_ = np.linalg.lstsq(A, np.asarray(travel_mm, dtype=float), rcond=None)
+    return float(mm_per_s), float(offset_mm)
+
+async def record_step(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict, direction, drive_s, limit_mm):
+    """
+    Holds the move command for drive_s (or until limit_mm), stops and waits
+    for rest. Returns (t_s, travel_mm, stop_s) relative to the move command, or None if cancelled.
+    """
+    params = autotune_params(config)
+    tuning = config["tuning_params"]
+    sign = 1 if direction == "UP" else -1
+    cmd = commands["move_up"] if direction == "UP" else commands["move_down"]
+
+    poller = None
+    if params["trace_poll_s"]:
+        poller = asyncio.create_task(
+            keepalive(motor.client, motor.write_uuid, commands["fetch_height"], params["trace_poll_s"]))
+    seq = context.heights.count
+    start_mm = context.current_mm
+    start_ns = now_ns()
+    motor.start(cmd)
+    try:
+        await wait_for_height(context, lambda mm: sign * (mm - limit_mm) >= 0, timeout_s=drive_s)
+        await motor.release()
+        await motor.stop()
+        stop_ns = motor.writes[-1].issued_ns
+        if not await wait_for_settle(context, tuning.get("settle_quiet_s", DEFAULT_SETTLE_QUIET_S), 5.0):
+            return None
+    finally:
+        await motor.release()
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+
+    t_ns, heights = context.heights.since(seq)
+    t_s = np.concatenate([[0.0], (np.asarray(t_ns, dtype=float) - start_ns) / 1e9])
+    travel = np.concatenate([[0.0], sign * (np.asarray(heights, dtype=float) - start_mm)])
+    return t_s, travel, (stop_ns - start_ns) / 1e9
+
+async def measure_pulses(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict, label=""):
+    """
+    Travel of every pulse length in pulses_s, pulse_repeats times per direction.
+    Returns {"UP": array (pulses x repeats), "DOWN": ...} in mm, or None if cancelled.
+    """
+    params = autotune_params(config)
+    settle_quiet_s = config["tuning_params"].get("settle_quiet_s", DEFAULT_SETTLE_QUIET_S)
+    limits = config["height_limits"]
+    middle_mm = int(round((limits["min_cm"] + limits["max_cm"]) * 5))
+    repeats = params["pulse_repeats"]
+    travel = {"UP": np.zeros((len(params["pulses_s"]), repeats)), "DOWN": np.zeros((len(params["pulses_s"]), repeats))}
+    for r in range(repeats):
+        # DOWN pulses travel further than UP ones, so every repeat starts from the middle again.
+        context.set_status(f"{label}pulses {r+1}/{repeats}: Moving to start pos ({middle_mm/10.0} cm)...")
+        if context.current_mm > middle_mm:
+            await move_to_start_pos(motor, context, commands["move_down"], middle_mm, False)
+        else:
+            await move_to_start_pos(motor, context, commands["move_up"], middle_mm, True)
+        await motor.stop()
+        if not await wait_for_settle(context, settle_quiet_s, 2.0): return None
+        for i, pulse_s in enumerate(params["pulses_s"]):
+            for direction in ("UP", "DOWN"):
+                if context.should_quit(): return None
+                sign = 1 if direction == "UP" else -1
+                cmd = commands["move_up"] if direction == "UP" else commands["move_down"]
+                test = f"{label}{direction} pulse {pulse_s}s ({r+1}/{repeats})"
+                context.set_status(f"{test}...")
+                start_mm = context.filtered_mm
+                await pulse(motor, cmd, pulse_s)
+                if not await wait_for_settle(context, settle_quiet_s, 2.0): return None
+                travel[direction][i, r] = sign * (context.filtered_mm - start_mm)
+                context.set_status(f"{test}: {travel[direction][i, r]:.0f} mm")
+    return travel
+
+def nudge_curve(pulses_s, travel_mm):
+    """[[pulse_s, median travel_mm], ...] as saved to nudge_curve_up/down."""
+    return [[float(s), round(float(mm), 1)] for s, mm in zip(pulses_s, np.median(travel_mm, axis=1))]
+
+async def run_nudge_calibration(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict):
+    """Measures the pulse curve around the middle of the height range. Returns measure_pulses' result."""
+    try:
+        return await measure_pulses(motor, context, config, commands, "Nudge ")
+    finally:
+        await motor.stop()
+
+async def run_system_id(motor: MotionScheduler, context: DeskContext, config: dict, commands: dict):
+    """
+    Records step responses in both directions, then pulses of every length
+    in pulses_s around the middle of the height range. Returns {"UP": (fits, pulses_mm), "DOWN": ...}, or None if cancelled.
+    """
+    params = autotune_params(config)
+    settle_quiet_s = config["tuning_params"].get("settle_quiet_s", DEFAULT_SETTLE_QUIET_S)
+    low_mm = int(round(config["height_limits"]["min_cm"] * 10)) + TABLE_EDGE_MARGIN_MM
+    high_mm = int(round(config["height_limits"]["max_cm"] * 10)) - TABLE_EDGE_MARGIN_MM
+    fits = {"UP": [], "DOWN": []}
+    try:
+        # Steps run back and forth between the low start and wherever the UP step ends.
+        context.set_status(f"SysID: Moving to start pos ({low_mm/10.0} cm)...")
+        if context.current_mm > low_mm:
+            await move_to_start_pos(motor, context, commands["move_down"], low_mm, False)
+        else:
+            await move_to_start_pos(motor, context, commands["move_up"], low_mm, True)
+        await motor.stop()
+        if not await wait_for_settle(context, settle_quiet_s, 2.0): return None
+
+        for i in range(params["steps"]):
+            for direction, limit_mm in (("UP", high_mm), ("DOWN", low_mm)):
+                context.set_status(f"SysID {direction} step {i+1}/{params['steps']}: Holding {params['step_s']}s...")
+                trace = await record_step(motor, context, config, commands, direction, params["step_s"], limit_mm)
+                if trace is None: return None
+                fit = fit_step(*trace)
+                fits[direction].append(fit)
+                context.set_status(f"SysID {direction} step {i+1}/{params['steps']}: {fit['cruise_mm_s']:.1f} mm/s, "
+                                   f"fit RMS {fit['rms_mm']:.2f} mm")
+
+        pulses_mm = await measure_pulses(motor, context, config, commands, "SysID ")
+        if pulses_mm is None: return None
+    except ValueError as e:
+        context.set_status(f"Error in fit: {e}")
+        return None
+    finally:
+        await motor.stop()
+
+    return {direction: (fits[direction], pulses_mm[direction]) for direction in ("UP", "DOWN")}
+
+async def async_ble_main(context: DeskContext, config: dict, commands: dict, test):
+    """Connects and runs test(motor, context). Returns its results, None if it failed."""
     client = None
+    motor = None
     results = None
     try:
         device_address = config["device_address"]
@@ -180,86 +586,236 @@ async def async_ble_main(context: DeskContext, config: dict, commands: dict, set
         notify_uuid = config["notify_uuid"]
         
         context.set_status(f"Scanning for {device_address}...")
-        client = BleakClient(device_address)
+        if simulator_enabled(config):
+            client = SimulatedBleakClient(config)
+        else:
+            client = create_bleak_client(config)
+        if context.recorder is not None:
+            client = RecordingClient(client, context.recorder)
+        client = CommandDispatcher(client, config)
         await client.connect(timeout=10.0)
         
-        context.set_status("Connected. Waking desk...")
-        await client.write_gatt_char(write_uuid, commands["stop"], response=False)
+        context.set_status(f"Connected{describe_connect(client)}. Waking desk...")
+        write_char = characteristic(client, write_uuid)
+        await client.write_gatt_char(write_char, commands["stop"], response=False)
         await asyncio.sleep(0.2)
         
         context.set_status("Starting height listener...")
         await client.start_notify(
-            notify_uuid,
+            characteristic(client, notify_uuid),
             lambda sender, data: notification_handler(sender, data, context)
         )
         
         context.set_status("Waking desk & getting initial height...")
-        await client.write_gatt_char(write_uuid, commands["fetch_height"], response=False)
+        await client.write_gatt_char(write_char, commands["fetch_height"], response=False)
         
-        # Wait for the first height reading
-        if not context.height_is_known_event.wait(timeout=10.0):
+        # Wait for the first height reading (without blocking the notification loop)
+        if not await wait_for_height(context, lambda mm: mm != 0, timeout_s=10.0):
             context.set_status("Error: No initial height received.")
             raise Exception("Desk did not report height.")
 
         # Run the main autotune task
-        results = await run_overshoot_test(client, context, config, commands, setpoint_mm)
+        motor = MotionScheduler(client, write_char, commands["stop"],
+                                config["tuning_params"].get("keepalive_s", DEFAULT_KEEPALIVE_S))
+        results = await test(motor, context)
+        if results is not None:
+            context.set_status("Autotune Complete.")
         
     except BleakError as e:
         context.set_status(f"BleakError: {e}")
     except Exception as e:
         context.set_status(f"Error: {e}")
     finally:
+        if motor is not None:
+            # Stop first: closing the scheduler only ends the refreshes.
+            try:
+                if client.is_connected:
+                    await motor.stop(emergency=True)
+            finally:
+                await motor.close()
         if client and client.is_connected:
             context.set_status("Disconnecting...")
             await client.stop_notify(config["notify_uuid"])
             await client.disconnect()
         context.set_status("Disconnected.")
-        context.quit_event.set()
+        context.request_quit()
     return results
 
-def run_ble_logic(context: DeskContext, config: dict, commands: dict, setpoint_mm):
-    """Entry point for the BLE thread"""
-    try:
-        return asyncio.run(async_ble_main(context, config, commands, setpoint_mm))
-    except Exception as e:
-        context.set_status(f"BLE Thread Error: {e}")
-        return None
-
 # -----------------------------------------------------------------
-# ASCII UI LOGIC (Runs in the Main thread)
+# ASCII UI LOGIC
 # -----------------------------------------------------------------
 
-def draw_ascii_ui(context: DeskContext, ble_thread: threading.Thread):
-    UI_LINES = 7
-    print("\n" * UI_LINES)
-    
+async def draw_ascii_ui(context: DeskContext, ble_task: asyncio.Task, max_fps: float = DEFAULT_MAX_FPS):
+    """Renderer task; redraws the changed lines when the context reports a change."""
+    def frame():
+        status, current_cm = context.get_data()
+        lines = [
+            "--- PID Autotune Running ---",
+            "",
+            f"  Current Height: {current_cm:.1f} cm",
+            "",
+            f"  Status: {status}",
+            "",
+            "  (Press Ctrl+C to stop)",
+        ]
+        return lines, f"{current_cm:.1f} cm {status}"
+
+    renderer = TerminalRenderer(7)
     try:
-        while ble_thread.is_alive() and not context.should_quit():
-            status, current_cm = context.get_data()
-            
-            ui_string = (
-                f"--- PID Autotune Running ---{CLEAR_LINE}\n"
-                f"{CLEAR_LINE}\n"
-                f"  Current Height: {current_cm:.1f} cm{CLEAR_LINE}\n"
-                f"{CLEAR_LINE}\n"
-                f"  Status: {status}{CLEAR_LINE}\n"
-                f"{CLEAR_LINE}\n"
-                f"  (Press Ctrl+C to stop){CLEAR_LINE}\n"
-            )
-            print(CURSOR_UP_N(UI_LINES), end="")
-            print(ui_string, end="")
-            time.sleep(0.05)
-
-    except KeyboardInterrupt:
-        print("\nStopping test...")
-        context.set_status("Manual quit... disconnecting...")
-        context.quit_event.set()
-
+        await run_renderer(context, renderer, frame,
+                           lambda: ble_task.done() or context.should_quit(), max_fps)
     finally:
-        ble_thread.join()
-        print(CURSOR_UP_N(UI_LINES), end="")
-        for _ in range(UI_LINES): print(f"{CLEAR_LINE}")
+        results = await ble_task
+        renderer.close()
         print("Autotune process finished.")
+        link = context.reassembler
+        if link.dropped_bytes or link.corrupt_frames:
+            print(f"Warning: {link.corrupt_frames} corrupt frames, {link.dropped_bytes} bytes dropped on the notify link.")
+    return results
+
+async def async_main(config: dict, commands: dict, test, session: str):
+    """Runs test(motor, context) and the renderer on one event loop. Returns the results."""
+    context = DeskContext()
+    context.recorder = open_recorder(config, f"autotune.py {session}")
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGINT, context.request_quit, "Manual quit... disconnecting...")
+    try:
+        ble_task = asyncio.create_task(async_ble_main(context, config, commands, test))
+        return await draw_ascii_ui(context, ble_task, config.get("ui", {}).get("max_fps", DEFAULT_MAX_FPS))
+    finally:
+        if context.recorder is not None:
+            context.recorder.close()
+            print(f"Telemetry appended to {context.recorder.path}")
+
+def table_setpoints_mm(min_cm: float, max_cm: float, count: int):
+    """count setpoints spread evenly over the range a test can reach without hitting the limits."""
+    if count < 2:
+        raise ValueError(count)
+    lowest = int(round(min_cm * 10)) + TABLE_EDGE_MARGIN_MM
+    highest = int(round(max_cm * 10)) - TABLE_EDGE_MARGIN_MM
+    return [int(round(mm)) for mm in np.linspace(lowest, highest, count)]
+
+def update_config(config_path: str, apply):
+    """Asks before changing the config file, backs it up and saves apply(config_data)."""
+    try:
+        choice = input(f"\nDo you want to update '{config_path}' with these values? (y/n): ").strip().lower()
+        if choice == 'y':
+            now = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+            backup_path = f"{config_path}.{now}.bak"
+            shutil.copy(config_path, backup_path)
+            print(f"\nBackup of original config saved to:\n{backup_path}")
+
+            with open(config_path, 'r') as f:
+                config_data = json.load(f)
+            apply(config_data)
+            with open(config_path, 'w') as f:
+                json.dump(config_data, f, indent=4)
+                
+            print(f"\nSuccessfully updated '{config_path}' with new parameters.")
+        else:
+            print("\nConfig file not updated.")
+    except Exception as e:
+        print(f"\nError updating config file: {e}")
+
+def sysid_main(config: dict, config_path: str, commands: dict):
+    """autotune.py sysid: fits the motor model and offers to save it."""
+    params = autotune_params(config)
+    results = run_async(async_main(config, commands,
+                                   lambda motor, context: run_system_id(motor, context, config, commands),
+                                   "sysid"), config)
+    if not results:
+        print("System identification was cancelled or failed. Config file not updated.")
+        return
+
+    model = {}
+    print("\n--- Motor Model ---")
+    print(f"  {'':<20}{'UP':>10}{'DOWN':>10}")
+    for direction, (fits, _) in results.items():
+        key = direction.lower()
+        for name in ("start_dead_time_s", "accel_mm_s2", "cruise_mm_s", "stop_dead_time_s", "decel_mm_s2"):
+            model[f"{name}_{key}"] = round(float(np.mean([fit[name] for fit in fits])), 3)
+        model[f"fit_rms_mm_{key}"] = round(float(np.mean([fit["rms_mm"] for fit in fits])), 2)
+    for name in ("start_dead_time_s", "accel_mm_s2", "cruise_mm_s", "stop_dead_time_s", "decel_mm_s2", "fit_rms_mm"):
+        print(f"  {name:<20}{model[name + '_up']:10.3f}{model[name + '_down']:10.3f}")
+
+    print("\n--- Pulses (median) ---")
+    print(f"  {'Pulse':>6} {'UP':>6} {'model':>6} {'DOWN':>6} {'model':>6}")
+    motors = {direction: MotorModel(direction, model) for direction in results}
+    for i, pulse_s in enumerate(params["pulses_s"]):
+        line = f"  {pulse_s:5.2f}s"
+        for direction, (_, pulses_mm) in results.items():
+            line += f" {np.median(pulses_mm[i]):4.1f}mm {motors[direction].travel_mm(pulse_s):4.1f}mm"
+        print(line)
+    for direction, (_, pulses_mm) in results.items():
+        key = direction.lower()
+        mm_per_s, offset_mm = fit_pulses(np.repeat(params["pulses_s"], pulses_mm.shape[1]), pulses_mm.ravel())
+        model[f"nudge_mm_per_s_{key}"] = round(mm_per_s, 2)
+        model[f"nudge_offset_mm_{key}"] = round(offset_mm, 2)
+        print(f"  {direction} nudge: {mm_per_s:.1f} mm/s x pulse {offset_mm:+.1f} mm")
+
+    def apply(config_data):
+        config_data["motor_model"] = model
+        tuning = config_data["tuning_params"]
+        # The coast predictor uses the same stop model.
+        tuning["decel_mm_s2_up"] = round(model["decel_mm_s2_up"], 1)
+        tuning["decel_mm_s2_down"] = round(model["decel_mm_s2_down"], 1)
+        tuning["stop_dead_time_s"] = round((model["stop_dead_time_s_up"] + model["stop_dead_time_s_down"]) / 2, 3)
+        # ...and the nudge loop the measured pulses.
+        for direction, (_, pulses_mm) in results.items():
+            tuning[f"nudge_curve_{direction.lower()}"] = nudge_curve(params["pulses_s"], pulses_mm)
+
+    update_config(config_path, apply)
+
+def nudge_main(config: dict, config_path: str, commands: dict):
+    """autotune.py nudge: measures the pulse length to travel curve and offers to save it."""
+    params = autotune_params(config)
+    results = run_async(async_main(config, commands,
+                                   lambda motor, context: run_nudge_calibration(motor, context, config, commands),
+                                   "nudge"), config)
+    if not results:
+        print("Nudge calibration was cancelled or failed. Config file not updated.")
+        return
+
+    curves = {direction: nudge_curve(params["pulses_s"], travel) for direction, travel in results.items()}
+    print("\n--- Nudge Curve ---")
+    print(f"  {'Pulse':>6} {'UP':>8} {'spread':>7} {'DOWN':>8} {'spread':>7}")
+    for i, pulse_s in enumerate(params["pulses_s"]):
+        line = f"  {pulse_s:5.2f}s"
+        for direction, travel in results.items():
+            line += f" {curves[direction][i][1]:6.1f}mm {np.ptp(travel[i]):5.1f}mm"
+        print(line)
+
+    def apply(config_data):
+        for direction, curve in curves.items():
+            config_data["tuning_params"][f"nudge_curve_{direction.lower()}"] = curve
+
+    update_config(config_path, apply)
+
+def keepalive_main(config: dict, config_path: str, commands: dict):
+    """autotune.py keepalive: finds how seldom the move command may be repeated and offers to save it."""
+    rows = run_async(async_main(config, commands,
+                                lambda motor, context: measure_keepalive(motor, context, config, commands),
+                                "keepalive"), config)
+    if not rows:
+        print("Keepalive test was cancelled or failed. Config file not updated.")
+        return
+
+    _, base_up, base_down = rows[0]
+    passed = [interval_s for interval_s, up, down in rows
+              if min(up / base_up, down / base_down) >= KEEPALIVE_MIN_SPEED_RATIO]
+    print("\n--- Keepalive Interval ---")
+    print(f"  {'Interval':>8} {'UP':>10} {'DOWN':>10}")
+    for interval_s, up, down in rows:
+        mark = "" if interval_s in passed else "  (desk slows down)"
+        print(f"  {interval_s * 1000:6.0f}ms {up:6.1f}mm/s {down:6.1f}mm/s{mark}")
+    keepalive_s = round(KEEPALIVE_SAFETY * passed[-1], 3)
+    print(f"  Longest interval that keeps full speed: {passed[-1] * 1000:.0f} ms")
+    print(f"  Suggested keepalive_s: {keepalive_s} (now {config['tuning_params'].get('keepalive_s', DEFAULT_KEEPALIVE_S)})")
+
+    def apply(config_data):
+        config_data["tuning_params"]["keepalive_s"] = keepalive_s
+
+    update_config(config_path, apply)
 
 # -----------------------------------------------------------------
 # MAIN FUNCTION
@@ -273,9 +829,16 @@ def main():
         print("Please install it: pip3 install numpy")
         sys.exit(1)
 
-    if len(sys.argv) != 2:
+    mode = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ("table", "sweep", "sysid", "nudge", "keepalive") else None
+    if (len(sys.argv) != 2 and mode is None) or (mode == "table" and len(sys.argv) > 3) \
+            or (mode == "sweep" and len(sys.argv) < 4) or (mode in ("sysid", "nudge", "keepalive") and len(sys.argv) != 2):
         print("Error: Invalid arguments.")
         print(f"Usage: sudo python3 {sys.argv[0]} <setpoint_cm>")
+        print(f"       sudo python3 {sys.argv[0]} table [num_setpoints]")
+        print(f"       sudo python3 {sys.argv[0]} sweep <setpoint_cm> <setpoint_cm> ...")
+        print(f"       sudo python3 {sys.argv[0]} sysid")
+        print(f"       sudo python3 {sys.argv[0]} nudge")
+        print(f"       sudo python3 {sys.argv[0]} keepalive")
         print(f"Example: sudo python3 {sys.argv[0]} 90.0")
         sys.exit(1)
 
@@ -293,20 +856,6 @@ def main():
         print(f"Error: Could not parse '{config_path}'. Is it valid JSON?")
         sys.exit(1)
 
-    # --- Validate Setpoint Argument ---
-    try:
-        setpoint_cm = float(sys.argv[1])
-        min_cm = config["height_limits"]["min_cm"]
-        max_cm = config["height_limits"]["max_cm"]
-        if not (min_cm + 10 <= setpoint_cm <= max_cm - 10):
-            print(f"Error: Setpoint must be at least 10cm within the height limits ({min_cm}-{max_cm} cm).")
-            print(f"Please choose a setpoint between {min_cm+10} and {max_cm-10}.")
-            sys.exit(1)
-        setpoint_mm = int(round(setpoint_cm * 10))
-    except ValueError:
-        print(f"Error: '{sys.argv[1]}' is not a valid height.")
-        sys.exit(1)
-    
     # --- Convert Hex Commands to Bytes ---
     try:
         commands_hex = config["commands"]
@@ -315,49 +864,114 @@ def main():
         print(f"Error converting commands in config file: {e}")
         sys.exit(1)
         
-    # --- Start Application ---
-    context = DeskContext()
+    if mode == "sysid":
+        sysid_main(config, config_path, commands_bytes)
+        return
+    if mode == "nudge":
+        nudge_main(config, config_path, commands_bytes)
+        return
+    if mode == "keepalive":
+        keepalive_main(config, config_path, commands_bytes)
+        return
+
+    min_cm = config["height_limits"]["min_cm"]
+    max_cm = config["height_limits"]["max_cm"]
+    table_mode = mode in ("table", "sweep")
     
-    results = None
-    def ble_thread_wrapper():
-        nonlocal results
-        results = run_ble_logic(context, config, commands_bytes, setpoint_mm)
-
-    ble_thread = threading.Thread(target=ble_thread_wrapper)
-    ble_thread.start()
+    # --- Validate Setpoint Argument ---
+    if mode == "table":
+        try:
+            setpoints_mm = table_setpoints_mm(min_cm, max_cm, int(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_TABLE_SETPOINTS)
+        except ValueError:
+            print("Error: number of setpoints must be an integer of at least 2.")
+            sys.exit(1)
+    elif mode == "sweep":
+        edge_cm = TABLE_EDGE_MARGIN_MM / 10.0
+        try:
+            setpoints_mm = sorted({int(round(float(arg) * 10)) for arg in sys.argv[2:]})
+        except ValueError:
+            print("Error: setpoints must be heights in cm.")
+            sys.exit(1)
+        if len(setpoints_mm) < 2 or not all(min_cm + edge_cm <= mm / 10.0 <= max_cm - edge_cm for mm in setpoints_mm):
+            print(f"Error: Give at least 2 different setpoints between {min_cm + edge_cm} and {max_cm - edge_cm} cm.")
+            sys.exit(1)
+    else:
+        try:
+            setpoint_cm = float(sys.argv[1])
+            if not (min_cm + 10 <= setpoint_cm <= max_cm - 10):
+                print(f"Error: Setpoint must be at least 10cm within the height limits ({min_cm}-{max_cm} cm).")
+                print(f"Please choose a setpoint between {min_cm+10} and {max_cm-10}.")
+                sys.exit(1)
+            setpoints_mm = [int(round(setpoint_cm * 10))]
+        except ValueError:
+            print(f"Error: '{sys.argv[1]}' is not a valid height.")
+            sys.exit(1)
     
-    draw_ascii_ui(context, ble_thread)
+    # --- Start Application ---
+    results = run_async(async_main(config, commands_bytes,
+                                   lambda motor, context: run_sweep(motor, context, config, commands_bytes, setpoints_mm),
+                                   f"setpoints_mm={setpoints_mm}"), config)
     
     # --- Handle Results and Update Config ---
     if results:
-        avg_up, avg_down = results
+        table = np.array([[setpoint_mm, stats_up.mean_mm, stats_down.mean_mm,
+                           np.nan if decel_up is None else decel_up, np.nan if decel_down is None else decel_down]
+                          for setpoint_mm, stats_up, stats_down, decel_up, decel_down in results], dtype=float)
+        setpoints, up, down, decels_up, decels_down = table.T
+        avg_up, avg_down = float(np.mean(up)), float(np.mean(down))
+        have_decel = not (np.isnan(decels_up).any() or np.isnan(decels_down).any())
+        decel_up = float(np.mean(decels_up)) if have_decel else None
+        decel_down = float(np.mean(decels_down)) if have_decel else None
+        
+        params = autotune_params(config)
+        print("\n--- Coast Statistics ---")
+        print(f"  {'Height':>8} {'Dir':>4} {'Tests':>5} {'Mean':>8} {'Std':>6} {'95% CI':>8}  Outliers")
+        for setpoint_mm, stats_up, stats_down, _, _ in results:
+            for direction, stats in (("UP", stats_up), ("DOWN", stats_down)):
+                converged = "" if stats.ci_width_mm <= params["ci_width_mm"] else " (not converged)"
+                outliers = ", ".join(f"{o:.0f}" for o in stats.outliers) or "-"
+                print(f"  {setpoint_mm/10.0:6.1f}cm {direction:>4} {stats.tests:5d} {stats.mean_mm:6.1f}mm "
+                      f"{np.sqrt(stats.var_mm2):4.1f}mm {stats.ci_width_mm:6.1f}mm  {outliers}{converged}")
         
         print("\n--- Autotune Results ---")
+        if table_mode:
+            print(f"  {'Height':>8} {'UP':>8} {'DOWN':>8}" + (f" {'UP decel':>10} {'DOWN decel':>10}" if have_decel else ""))
+            for row in table:
+                line = f"  {row[0]/10.0:6.1f}cm {row[1]:6.1f}mm {row[2]:6.1f}mm"
+                if have_decel:
+                    line += f" {row[3]:10.0f} {row[4]:10.0f}"
+                print(line)
         print(f"  Avg. UP Overshoot:   {avg_up/10.0:.2f} cm ({avg_up:.0f} mm)")
         print(f"  Avg. DOWN Overshoot: {avg_down/10.0:.2f} cm ({avg_down:.0f} mm)")
+        if decel_up and decel_down:
+            print(f"  UP Deceleration:     {decel_up:.0f} mm/s^2")
+            print(f"  DOWN Deceleration:   {decel_down:.0f} mm/s^2")
         
-        try:
-            choice = input("\nDo you want to update 'config.json' with these values? (y/n): ").strip().lower()
-            if choice == 'y':
-                now = datetime.now().strftime("%Y-%m-%d_%H%M%S")
-                backup_path = f"{config_path}.{now}.bak"
-                shutil.copy(config_path, backup_path)
-                print(f"\nBackup of original config saved to:\n{backup_path}")
-
-                with open(config_path, 'r') as f:
-                    config_data = json.load(f)
-                
-                config_data["tuning_params"]["overshoot_mm_up"] = int(round(avg_up))
-                config_data["tuning_params"]["overshoot_mm_down"] = int(round(avg_down))
-                
-                with open(config_path, 'w') as f:
-                    json.dump(config_data, f, indent=4)
-                    
-                print(f"\nSuccessfully updated '{config_path}' with new parameters.")
+        def apply(config_data):
+            tuning = config_data["tuning_params"]
+            if table_mode:
+                # The scalars are the table means, so the tables apply unshifted.
+                tuning["overshoot_mm_up"] = round(avg_up, 1)
+                tuning["overshoot_mm_down"] = round(avg_down, 1)
+                tuning["overshoot_table_up"] = [[int(h), round(float(v), 1)] for h, v in zip(setpoints, up)]
+                tuning["overshoot_table_down"] = [[int(h), round(float(v), 1)] for h, v in zip(setpoints, down)]
+                if have_decel:
+                    tuning["decel_table_up"] = [[int(h), round(float(v), 1)] for h, v in zip(setpoints, decels_up)]
+                    tuning["decel_table_down"] = [[int(h), round(float(v), 1)] for h, v in zip(setpoints, decels_down)]
+                if decel_up and decel_down:
+                    tuning["decel_mm_s2_up"] = round(decel_up, 1)
+                    tuning["decel_mm_s2_down"] = round(decel_down, 1)
             else:
-                print("\nConfig file not updated.")
-        except Exception as e:
-            print(f"\nError updating config file: {e}")
+                # One height: store the level that reproduces it through any existing height tables.
+                height_mm = float(setpoints[0])
+                predictors = {key: CoastPredictor(key.upper(), tuning) for key in ("up", "down")}
+                tuning["overshoot_mm_up"] = int(round(predictors["up"].overshoot_level(height_mm, avg_up)))
+                tuning["overshoot_mm_down"] = int(round(predictors["down"].overshoot_level(height_mm, avg_down)))
+                if decel_up and decel_down:
+                    tuning["decel_mm_s2_up"] = round(predictors["up"].decel_level(height_mm, decel_up), 1)
+                    tuning["decel_mm_s2_down"] = round(predictors["down"].decel_level(height_mm, decel_down), 1)
+
+        update_config(config_path, apply)
     else:
         print("Autotune was cancelled or failed. Config file not updated.")
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+End-to-end move benchmark against the simulated desk.
+
+Runs the real connect_desk / move_task code against SimulatedBleakClient on
+a virtual clock for a matrix of start and target heights (both directions),
+desk loads and notification jitter. For every case it reports the
+simulated time until the desk is within final_margin_mm for good, the final
+error, nudges, BLE writes and the CPU time the run took, and saves
+everything as JSON. Pass an earlier result file to print the change in the
+summary numbers.
+
+Tuning parameters come from config.json in the repository root, or the
+file given with --config (e.g. one autotune sysid has written a
+motor_model to). --staged turns the move planner off, so the planner and
+the staged loop can be compared on the same calibration.
+
+Usage: python3 benchmarks/bench_moves.py [--config config.json] [--staged] [output.json] [baseline.json]
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from desk_dispatch import CommandDispatcher  # noqa: E402
+from desk_sim import SimulatedBleakClient, run_virtual  # noqa: E402
+from desk_telemetry import now_ns  # noqa: E402
+from desk_timing import StageTimer  # noqa: E402
+from move_smart_cli import CONFIG_FILENAME, DeskContext, connect_desk, move_task  # noqa: E402
+
+HEIGHTS_MM = [820, 950, 1080]
+LOADS_KG = [0.0, 20.0, 40.0]
+JITTERS_S = [0.0, 0.02]
+DEFAULT_OUTPUT = "bench_moves.json"
+
+
+def cases():
+    """(start_mm, target_mm, load_kg, jitter_s) for every combination, both directions."""
+    for (start_mm, target_mm), load_kg, jitter_s in itertools.product(
+            itertools.permutations(HEIGHTS_MM, 2), LOADS_KG, JITTERS_S):
+        yield start_mm, target_mm, load_kg, jitter_s
+
+
+def settled_after_s(context: DeskContext, start_ns: int, margin_mm: int):
+    """Seconds from start_ns until the height entered the margin for the last time, None if it ended outside."""
+    t_ns, heights = context.heights.window()
+    inside_since = None
+    for t, h in zip(t_ns, heights):
+        if t < start_ns:
+            continue
+        if abs(context.target_mm - h) <= margin_mm:
+            if inside_since is None:
+                inside_since = t
+        else:
+            inside_since = None
+    return None if inside_since is None else (inside_since - start_ns) / 1e9
+
+
+async def run_case(config: dict, commands: dict, target_mm: int, timer: StageTimer):
+    context = DeskContext(target_mm / 10.0)
+    context.timer = timer
+    timer.new_run()
+    client = CommandDispatcher(SimulatedBleakClient(config), config, timer)
+    await connect_desk(client, context, config, commands)
+    start_ns = now_ns()
+    await move_task(client, context, config, commands)
+    end_ns = now_ns()
+    await client.disconnect()
+    return context, client, start_ns, end_ns
+
+
+def bench_case(base_config: dict, commands: dict, timer: StageTimer, index: int,
+               start_mm: int, target_mm: int, load_kg: float, jitter_s: float, staged: bool = False) -> dict:
+    config = copy.deepcopy(base_config)
+    config["simulator"] = dict(config.get("simulator", {}), enabled=True, virtual_time=True,
+                               start_mm=start_mm, load_kg=load_kg, notify_jitter_s=jitter_s, seed=index)
+    # Every case starts from the tuning in config.json, never from learned state.
+    config["learning"] = dict(config.get("learning", {}), enabled=False)
+    if staged:
+        config["planner"] = dict(config.get("planner", {}), enabled=False)
+    margin_mm = config["tuning_params"]["final_margin_mm"]
+
+    cpu_start = time.process_time()
+    context, client, start_ns, end_ns = run_virtual(run_case(config, commands, target_mm, timer))
+    cpu_s = time.process_time() - cpu_start
+
+    return {
+        "start_mm": start_mm,
+        "target_mm": target_mm,
+        "direction": "UP" if target_mm > start_mm else "DOWN",
+        "load_kg": load_kg,
+        "jitter_s": jitter_s,
+        "time_to_margin_s": settled_after_s(context, start_ns, margin_mm),
+        "move_time_s": (end_ns - start_ns) / 1e9,
+        "final_error_mm": context.target_mm - context.current_mm,
+        "nudges": context.timer.summary().get("nudge", {}).get("count", 0),
+        "writes": client.writes,
+        "cpu_s": cpu_s,
+        "status": context.status,
+    }
+
+
+def summarize(results) -> dict:
+    reached = [r["time_to_margin_s"] for r in results if r["time_to_margin_s"] is not None]
+    n = len(results)
+    return {
+        "cases": n,
+        "within_margin": len(reached),
+        "mean_time_to_margin_s": sum(reached) / len(reached) if reached else None,
+        "max_time_to_margin_s": max(reached) if reached else None,
+        "mean_abs_error_mm": sum(abs(r["final_error_mm"]) for r in results) / n,
+        "mean_nudges": sum(r["nudges"] for r in results) / n,
+        "mean_writes": sum(r["writes"] for r in results) / n,
+        "total_cpu_s": sum(r["cpu_s"] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end move benchmark against the simulated desk.")
+    parser.add_argument("output", nargs="?", default=DEFAULT_OUTPUT)
+    parser.add_argument("baseline", nargs="?")
+    parser.add_argument("--config", default=os.path.join(ROOT, CONFIG_FILENAME))
+    parser.add_argument("--staged", action="store_true", help="disable the move planner")
+    args = parser.parse_args()
+    output_path, baseline_path = args.output, args.baseline
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    commands = {name: bytes.fromhex(cmd) for name, cmd in config["commands"].items()}
+
+    timer = StageTimer()
+    results = []
+    print(f"{'start':>6} {'target':>6} {'load':>5} {'jit':>5} {'t_margin':>9} {'err':>4} "
+          f"{'nudges':>6} {'writes':>6} {'cpu_ms':>7}")
+    for index, case in enumerate(cases()):
+        r = bench_case(config, commands, timer, index, *case, staged=args.staged)
+        results.append(r)
+        t_margin = f"{r['time_to_margin_s']:8.2f}s" if r["time_to_margin_s"] is not None else "        -"
+        print(f"{r['start_mm']:6d} {r['target_mm']:6d} {r['load_kg']:5.0f} {r['jitter_s']:5.2f} {t_margin} "
+              f"{r['final_error_mm']:4d} {r['nudges']:6d} {r['writes']:6d} {r['cpu_s'] * 1000:7.1f}")
+
+    summary = summarize(results)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "controller": "staged" if args.staged or "motor_model" not in config else "planner",
+        "tuning_params": config["tuning_params"],
+        "summary": summary,
+        "stage_latency": timer.histogram_summary(),
+        "results": results,
+    }
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print("\n--- Summary ---")
+    baseline = None
+    if baseline_path:
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)["summary"]
+    for key, value in summary.items():
+        shown = "-" if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+        line = f"  {key:<24}{shown:>10}"
+        if baseline is not None and isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)):
+            line += f"   (baseline {baseline[key]:.3f}, {value - baseline[key]:+.3f})"
+        print(line)
+    print(f"Results written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
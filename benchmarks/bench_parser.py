@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: height packets parsed per second.
+
+Compares the old hex-string scan used by notification_handler with what
+it does now: FrameReassembler.feed from desk_protocol, which also handles
+frames split across or packed into notifications.
+
+Usage: python3 benchmarks/bench_parser.py [num_packets]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from desk_protocol import FrameReassembler, HeightFrame, build_height_frame  # noqa: E402
+
+
+def legacy_heights(packets):
+    """The original notification_handler parsing, minus the context update."""
+    heights = []
+    for data in packets:
+        hex_data = data.hex()
+        try:
+            index = hex_data.index("f2f20103")
+            heights.append(int(hex_data[index + 8 : index + 12], 16))
+        except ValueError:
+            pass
+    return heights
+
+
+def reassembler_heights(packets, reassembler=None):
+    """What notification_handler does now, minus the context update."""
+    feed = (reassembler or FrameReassembler()).feed
+    heights = []
+    for data in packets:
+        for frame in feed(data):
+            if isinstance(frame, HeightFrame):
+                heights.append(frame.height_mm)
+    return heights
+
+
+def bench(parse, packets, repeat=7):
+    """Best-of-N throughput in packets per second."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(packets)
+        best = min(best, time.perf_counter() - start)
+    return len(packets) / best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    packets = [bytearray(build_height_frame(800 + (i % 310))) for i in range(count)]
+
+    assert legacy_heights(packets[:1000]) == reassembler_heights(packets[:1000])
+
+    print(f"Parsing {count} height packets...")
+    before = bench(legacy_heights, packets)
+    after = bench(reassembler_heights, packets)
+    print(f"  hex-string scan:   {before:12,.0f} packets/s")
+    print(f"  FrameReassembler:  {after:12,.0f} packets/s")
+    print(f"  speedup:           {after / before:12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
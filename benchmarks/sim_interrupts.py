@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Interrupted moves against the simulated desk.
+
+Runs the real move_task through the connection supervisor on a virtual
+clock and interrupts it the ways the CLI and the daemon do:
+
+    quit       request_quit() mid-approach, as Ctrl+C does
+    new_move   a second move started mid-approach, as the daemon does
+    drop       the link drops mid-move (simulator drop_after_s) and comes back
+    give_up    the link drops mid-move and every reconnect fails
+
+Every scenario must finish within a deadline, and an interrupted move must
+end with a stop write while the desk is still connected. When the
+supervisor gives up, run() must raise and the context must be asked to
+quit, so the CLI exits and the daemon reports it. Exits non-zero if
+any scenario fails, so it can be run as a regression check.
+
+Usage: python3 benchmarks/sim_interrupts.py [--config config.json]
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from desk_dispatch import CommandDispatcher  # noqa: E402
+from desk_link import ConnectionSupervisor  # noqa: E402
+from desk_sim import SimulatedBleakClient, run_virtual  # noqa: E402
+from move_smart_cli import CONFIG_FILENAME, DeskContext, connect_desk, move_task  # noqa: E402
+
+START_MM = 800
+TARGET_MM = 1050
+INTERRUPT_AFTER_S = 2.0     # Well inside the fast approach
+DEADLINE_S = 60.0           # Simulated time any scenario may take
+
+
+class WriteLog:
+    """Wraps the client, remembers every command written to it and can refuse to connect."""
+    def __init__(self, client):
+        self._client = client
+        self.writes = []
+        self.refuse_connects = False
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def connect(self, **kwargs):
+        if self.refuse_connects:
+            raise ConnectionError("Simulated desk is out of range")
+        return await self._client.connect(**kwargs)
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        self.writes.append(bytes(data))
+        return await self._client.write_gatt_char(char_specifier, data, response=response)
+
+
+def sim_config(base_config: dict, **sim) -> dict:
+    config = copy.deepcopy(base_config)
+    config["simulator"] = dict(config.get("simulator", {}), enabled=True, virtual_time=True,
+                               start_mm=START_MM, seed=0, **sim)
+    config["learning"] = dict(config.get("learning", {}), enabled=False)
+    return config
+
+
+async def run_scenario(name: str, config: dict, commands: dict) -> str:
+    """Runs one scenario; returns an empty string on success, else what went wrong."""
+    context = DeskContext(TARGET_MM / 10.0)
+    logs = []
+
+    def create_client(on_disconnect):
+        logs.append(WriteLog(SimulatedBleakClient(config, disconnected_callback=on_disconnect)))
+        return CommandDispatcher(logs[-1], config)
+
+    supervisor = ConnectionSupervisor(context, create_client,
+                                      lambda client: connect_desk(client, context, config, commands),
+                                      config.get("reconnect"))
+    log = logs[0]
+    desk = log.desk
+
+    def make_move():
+        return move_task(supervisor.client, context, config, commands)
+
+    await supervisor.start()
+    log.refuse_connects = name == "give_up"
+    move = asyncio.create_task(supervisor.run(make_move))
+    try:
+        if name == "give_up":
+            done, _ = await asyncio.wait({move}, timeout=DEADLINE_S)
+            if not done:
+                return "run() did not return after reconnecting failed"
+            if not isinstance(move.exception(), ConnectionError):
+                return f"run() ended with {move.exception()!r} instead of a ConnectionError"
+            if not context.should_quit():
+                return "the context was not asked to quit"
+            return ""
+
+        if name == "drop":
+            done, _ = await asyncio.wait({move}, timeout=DEADLINE_S)
+            if not done:
+                return "move did not finish after the link drop"
+            if supervisor.reconnects != 1:
+                return f"expected 1 reconnect, got {supervisor.reconnects}"
+            margin_mm = config["tuning_params"]["final_margin_mm"]
+            if abs(context.error_mm) > margin_mm:
+                return f"ended {context.error_mm} mm from the target"
+            return ""
+
+        await asyncio.sleep(INTERRUPT_AFTER_S)
+        if not desk.is_moving:
+            return "desk was not moving when interrupted"
+        context.request_quit()
+        done, _ = await asyncio.wait({move}, timeout=DEADLINE_S)
+        if not done:
+            return "move did not stop after quit"
+        if log.writes[-1] != commands["stop"]:
+            return "the last write was not a stop"
+        if name == "new_move":
+            context.quit_event.clear()
+            context.set_target(START_MM / 10.0)
+            move = asyncio.create_task(supervisor.run(make_move))
+            done, _ = await asyncio.wait({move}, timeout=DEADLINE_S)
+            if not done:
+                return "second move did not finish"
+        return ""
+    finally:
+        if not move.done():
+            move.cancel()
+        await supervisor.close()
+        await supervisor.client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Interrupted moves against the simulated desk.")
+    parser.add_argument("--config", default=os.path.join(ROOT, CONFIG_FILENAME))
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        base_config = json.load(f)
+    commands = {name: bytes.fromhex(cmd) for name, cmd in base_config["commands"].items()}
+
+    scenarios = [
+        ("quit", sim_config(base_config)),
+        ("new_move", sim_config(base_config)),
+        ("drop", sim_config(base_config, drop_after_s=INTERRUPT_AFTER_S)),
+        ("give_up", dict(sim_config(base_config, drop_after_s=INTERRUPT_AFTER_S),
+                         reconnect=dict(base_config.get("reconnect", {}), max_attempts=3))),
+    ]
+    failures = 0
+    for name, config in scenarios:
+        error = run_virtual(run_scenario(name, config, commands))
+        print(f"  {name:<10} {'FAIL: ' + error if error else 'ok'}")
+        failures += bool(error)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
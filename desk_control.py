@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Motion primitives shared by move_smart_cli.py and autotune.py.
+
+The context object passed in must provide `current_mm`, `should_quit()` and
+`height_changed`, an asyncio.Event that notification_handler sets on every
+new height sample and request_quit() sets on quit, so waiters never poll.
+
+Move commands go through one MotionScheduler per connection. It repeats the
+active direction once per keepalive interval, measured from when the last
+refresh was issued, so slow writes do not stretch it, and never has more
+than one refresh in flight. stop() cancels the refresh and goes ahead of
+anything queued on the connection's CommandDispatcher (desk_dispatch.py);
+stop(emergency=True) does not even wait for a write in flight. Every write
+is timestamped.
+"""
+
+import asyncio
+from collections import deque
+from typing import Deque, NamedTuple, Optional
+
+from desk_dispatch import PRIORITY_EMERGENCY
+from desk_telemetry import now_ns
+
+# The desk stops on its own if a move command is not repeated.
+DEFAULT_KEEPALIVE_S = 0.1
+# The desk is considered at rest after this long without a height change.
+DEFAULT_SETTLE_QUIET_S = 0.4
+# wait_for_settle() results; both are true, only a quit returns False.
+SETTLED = "settled"
+SETTLE_TIMEOUT = "timeout"
+# Command writes kept in MotionScheduler.writes
+WRITE_LOG_SIZE = 256
+
+
+async def keepalive(client, write_uuid, cmd, interval_s=DEFAULT_KEEPALIVE_S):
+    """Repeats a command (e.g. a height request) on its own timer until cancelled."""
+    while True:
+        await client.write_gatt_char(write_uuid, cmd, response=False)
+        await asyncio.sleep(interval_s)
+
+
+class CommandWrite(NamedTuple):
+    issued_ns: int              # Event loop clock when the write was handed to the client
+    latency_ns: int             # ...until the client returned
+    cmd: bytes
+
+
+class MotionScheduler:
+    """
+    The single writer of move and stop commands on one connection. Optional
+    timer (a StageTimer) gets "write" latency and "keepalive" interval
+    histograms.
+    """
+    def __init__(self, client, write_uuid, stop_cmd, interval_s=DEFAULT_KEEPALIVE_S, timer=None):
+        self.client = client
+        self.write_uuid = write_uuid
+        self.stop_cmd = stop_cmd
+        self.interval_s = interval_s
+        self.timer = timer
+        self.cmd: Optional[bytes] = None    # Direction being held, None when idle
+        self.writes: Deque[CommandWrite] = deque(maxlen=WRITE_LOG_SIZE)
+        self._wake = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def write(self, cmd, priority=None):
+        """Writes one command now, and logs it unless the dispatcher dropped it."""
+        issued_ns = now_ns()
+        if priority is None:
+            written = await self.client.write_gatt_char(self.write_uuid, cmd, response=False)
+        else:
+            written = await self.client.write_gatt_char(self.write_uuid, cmd, response=False, priority=priority)
+        if written is False:
+            return
+        latency_ns = now_ns() - issued_ns
+        self.writes.append(CommandWrite(issued_ns, latency_ns, cmd))
+        if self.timer is not None:
+            self.timer.observe("write", latency_ns)
+
+    def start(self, cmd):
+        """Holds cmd until release() or stop(); the first write goes out at once."""
+        if cmd == self.cmd:
+            return
+        self.cmd = cmd
+        self._wake.set()
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def release(self):
+        """Stops refreshing without sending stop; raises if a refresh write failed."""
+        self.cmd = None
+        self._wake.set()
+        if self._task is not None and self._task.done():
+            task, self._task = self._task, None
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def stop(self, emergency=False):
+        """
+        Sends stop ahead of any queued write. An emergency stop is not even
+        held back by a write in flight; it needs a CommandDispatcher.
+        """
+        self.cmd = None
+        self._wake.set()
+        await self.write(self.stop_cmd, PRIORITY_EMERGENCY if emergency else None)
+
+    async def close(self):
+        """
+        Stops refreshing and waits for the task to end. Does not send stop;
+        callers that may leave the desk moving send stop() first.
+        """
+        self.cmd = None
+        if self._task is not None:
+            # Cancelling is not enough: on Python < 3.12 asyncio.wait_for
+            # swallows a cancel that arrives just as its event is set.
+            self._closing = True
+            self._wake.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sleep(self, delay_s):
+        """Sleeps delay_s, or until start(), release(), stop() or close() wakes the task."""
+        handle = asyncio.get_running_loop().call_later(delay_s, self._wake.set)
+        try:
+            await self._wake.wait()
+        finally:
+            handle.cancel()
+
+    async def _run(self):
+        last_ns = None
+        while not self._closing:
+            self._wake.clear()
+            cmd = self.cmd
+            if cmd is None:
+                last_ns = None
+                await self._wake.wait()
+                continue
+            issued_ns = now_ns()
+            if last_ns is not None and self.timer is not None:
+                self.timer.observe("keepalive", issued_ns - last_ns)
+            last_ns = issued_ns
+            await self.write(cmd)
+            delay_s = self.interval_s - (now_ns() - issued_ns) / 1e9
+            if delay_s > 0 and self.cmd == cmd:
+                await self._sleep(delay_s)
+
+
+async def wait_event(event: asyncio.Event, timeout_s: float) -> bool:
+    """
+    Waits for event at most timeout_s; True if it is set. Unlike
+    asyncio.wait_for on Python < 3.12, never swallows a cancel that arrives
+    just as the event is set.
+    """
+    if event.is_set():
+        return True
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait((waiter,), timeout=timeout_s)
+    finally:
+        waiter.cancel()
+    return event.is_set()
+
+
+async def wait_for_height(context, reached, timeout_s=None):
+    """
+    Waits until reached(current_mm) is true, waking on every height sample.
+    Returns False on quit or timeout.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout_s is None else loop.time() + timeout_s
+    while True:
+        context.height_changed.clear()
+        if reached(context.current_mm):
+            return True
+        if context.should_quit():
+            return False
+        if deadline is None:
+            await context.height_changed.wait()
+            continue
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        await wait_event(context.height_changed, remaining)
+
+
+async def wait_for_settle(context, quiet_s=DEFAULT_SETTLE_QUIET_S, timeout_s=2.0):
+    """
+    Waits until no height change has been seen for quiet_s, or at most
+    timeout_s. Returns SETTLED once the height was quiet for quiet_s,
+    SETTLE_TIMEOUT if it was still changing at timeout_s, and False only
+    if the user quit.
+    """
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    deadline = now + timeout_s
+    last_change = now
+    while True:
+        context.height_changed.clear()
+        if context.should_quit():
+            return False
+        now = loop.time()
+        quiet_left = last_change + quiet_s - now
+        if quiet_left <= 0:
+            return SETTLED
+        if now >= deadline:
+            return SETTLE_TIMEOUT
+        if await wait_event(context.height_changed, min(quiet_left, deadline - now)):
+            last_change = loop.time()
+
+
+async def drive_until(motor: MotionScheduler, context, cmd, reached):
+    """
+    Drives the desk with cmd until reached(current_mm) is true. The move
+    command is refreshed by the scheduler, so the caller can send stop the
+    moment the height sample that crosses the threshold arrives.
+    """
+    motor.start(cmd)
+    try:
+        return await wait_for_height(context, reached)
+    finally:
+        await motor.release()
+
+
+async def drive_until_deadline(motor: MotionScheduler, context, cmd, deadline):
+    """
+    Drives the desk with cmd until the loop clock reaches deadline(). The
+    deadline is re-evaluated on every height sample, so a planner can move
+    the stop between samples. The caller sends stop. Returns False on quit.
+    """
+    loop = asyncio.get_running_loop()
+    motor.start(cmd)
+    try:
+        while True:
+            context.height_changed.clear()
+            if context.should_quit():
+                return False
+            remaining = deadline() - loop.time()
+            if remaining <= 0:
+                return True
+            await wait_event(context.height_changed, remaining)
+    finally:
+        await motor.release()
+
+
+async def pulse(motor: MotionScheduler, cmd, duration_s):
+    """Drives with cmd for duration_s, refreshed like drive_until, then sends stop."""
+    motor.start(cmd)
+    try:
+        await asyncio.sleep(duration_s)
+    finally:
+        await motor.release()
+    await motor.stop()
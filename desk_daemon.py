@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Long-running desk daemon.
+
+Owns a single BLE connection and the height notification subscription,
+keeps the latest height cached and accepts requests over a Unix domain
+socket, so a move costs one socket round trip instead of a full
+connect / wake / subscribe sequence.
+
+Requests and replies are single JSON lines:
+
+    {"cmd": "move", "target_cm": 95.5}           -> accepted immediately
+    {"cmd": "move", "target_cm": 95.5, "wait": true}  -> reply when done
+    {"cmd": "status"}
+    {"cmd": "stop"}
+
+Once reconnecting has failed for good, every reply has "ok": false and the
+reason in "error", and moves are refused; restart the daemon to retry.
+
+Usage: sudo python3 desk_daemon.py
+"""
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+from desk_control import wait_for_height
+from desk_scan import connect_report
+from desk_telemetry import open_recorder
+from move_smart_cli import CONFIG_FILENAME, DeskContext, create_supervisor, move_task
+
+DEFAULT_SOCKET_PATH = "/tmp/ble_desk.sock"
+MAX_REQUEST_BYTES = 4096
+
+
+def socket_path(config: dict) -> str:
+    return config.get("daemon", {}).get("socket_path", DEFAULT_SOCKET_PATH)
+
+
+def send_request(config: dict, request: dict, timeout: float = 5.0) -> dict:
+    """
+    Sends one request to a running daemon and returns its reply.
+    Raises FileNotFoundError / ConnectionRefusedError if no daemon is running.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(None if request.get("wait") else timeout)
+        sock.connect(socket_path(config))
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(MAX_REQUEST_BYTES)
+            if not chunk:
+                break
+            reply += chunk
+    return json.loads(reply)
+
+
+class DaemonContext(DeskContext):
+    """DeskContext that logs status changes instead of drawing a UI."""
+    def __init__(self):
+        super().__init__(0.0)
+        self.is_moving = False
+
+    def set_status(self, new_status):
+        if new_status != self.status:
+            print(f"[{time.strftime('%H:%M:%S')}] {new_status}", flush=True)
+        super().set_status(new_status)
+
+
+class DeskServer:
+    """Serves socket requests against one supervised desk connection."""
+    def __init__(self, supervisor, context: DaemonContext, config: dict, commands: dict):
+        self.supervisor = supervisor
+        self.context = context
+        self.config = config
+        self.commands = commands
+        self.move = None
+
+    def state(self) -> dict:
+        status, current_cm, target_cm, error_cm = self.context.get_display_data()
+        failure = self.supervisor.failure
+        return {
+            "ok": failure is None,
+            "error": failure,
+            "status": status,
+            "height_cm": current_cm,
+            "target_cm": target_cm,
+            "error_cm": error_cm,
+            "moving": self.move is not None and not self.move.done(),
+            "connected": self.supervisor.connected.is_set(),
+            "reconnects": self.supervisor.reconnects,
+            "reconnect_latencies_s": self.supervisor.reconnect_latencies_s[-10:],
+            "last_move_stages": self.context.timer.summary(),
+            "stage_latency": self.context.timer.histogram_summary(),
+            "command_queue": self.supervisor.client.stats(),
+            "last_connect": connect_report(self.supervisor.client),
+        }
+
+    async def stop_move(self):
+        if self.move is not None:
+            if not self.move.done():
+                self.context.request_quit()
+            try:
+                await self.move
+            except ConnectionError:
+                pass    # The supervisor gave up; state() reports it
+        self.move = None
+
+    async def start_move(self, target_cm: float):
+        await self.stop_move()
+        self.context.quit_event.clear()
+        self.context.set_target(target_cm)
+        self.context.timer.new_run()
+        if self.context.recorder is not None:
+            self.context.recorder.move(self.context.target_mm)
+        self.context.is_moving = True
+        supervisor = self.supervisor
+        self.move = asyncio.create_task(supervisor.run(
+            lambda: move_task(supervisor.client, self.context, self.config, self.commands)))
+
+    async def dispatch(self, request: dict) -> dict:
+        cmd = request.get("cmd")
+        if cmd == "status":
+            return self.state()
+        if cmd == "stop":
+            await self.stop_move()
+            return self.state()
+        if cmd == "move":
+            try:
+                target_cm = float(request["target_cm"])
+            except (KeyError, TypeError, ValueError):
+                return {"ok": False, "error": "move needs a numeric target_cm"}
+            min_cm = self.config["height_limits"]["min_cm"]
+            max_cm = self.config["height_limits"]["max_cm"]
+            if not (min_cm <= target_cm <= max_cm):
+                return {"ok": False, "error": f"Height {target_cm}cm is outside valid range ({min_cm}-{max_cm})."}
+            if self.supervisor.failure is not None:
+                return self.state()
+            await self.start_move(target_cm)
+            if request.get("wait"):
+                try:
+                    await self.move
+                except ConnectionError:
+                    pass    # Reported by state()
+            return self.state()
+        return {"ok": False, "error": f"Unknown command: {cmd!r}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            try:
+                request = json.loads(line)
+                reply = await self.dispatch(request) if isinstance(request, dict) else {"ok": False, "error": "Request must be a JSON object"}
+            except json.JSONDecodeError:
+                reply = {"ok": False, "error": "Request is not valid JSON"}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(config: dict, commands: dict):
+    context = DaemonContext()
+    context.recorder = open_recorder(config, "desk_daemon.py")
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    path = socket_path(config)
+    supervisor = create_supervisor(context, config, commands)
+    server = None
+    desk = None
+    try:
+        await supervisor.start()
+        if not await wait_for_height(context, lambda mm: mm != 0, timeout_s=10.0):
+            context.set_status("Error: No height data. Is desk on?")
+            return
+
+        desk = DeskServer(supervisor, context, config, commands)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(desk.handle, path=path, limit=MAX_REQUEST_BYTES)
+        context.set_status(f"Ready at {context.current_mm / 10.0:.1f} cm, listening on {path}")
+        await stop_event.wait()
+    except Exception as e:
+        context.set_status(f"Error: {e}")
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            if os.path.exists(path):
+                os.unlink(path)
+        if desk is not None:
+            await desk.stop_move()
+        await supervisor.close()
+        client = supervisor.client
+        if client.is_connected:
+            context.set_status("Disconnecting...")
+            await client.stop_notify(config["notify_uuid"])
+            await client.disconnect()
+        context.set_status("Daemon stopped.")
+        if context.recorder is not None:
+            context.recorder.close()
+
+
+def main():
+    try:
+        with open(CONFIG_FILENAME, 'r') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        print(f"Error: Config file '{CONFIG_FILENAME}' not found.")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not parse '{CONFIG_FILENAME}'. Is it valid JSON?")
+        sys.exit(1)
+
+    try:
+        commands = {name: bytes.fromhex(cmd) for name, cmd in config["commands"].items()}
+    except Exception as e:
+        print(f"Error converting commands in config file: {e}")
+        sys.exit(1)
+
+    # Requests arrive in real time, so the simulator's virtual clock is not used here.
+    asyncio.run(serve(config, commands))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+One command queue per desk connection.
+
+CommandDispatcher wraps the client (BleakClient, the simulator or a
+RecordingClient) and sends every write_gatt_char through a single writer
+task, one write at a time, highest priority first:
+
+    emergency stop   written at once, even past a write still in flight
+    stop             next in line
+    motion           move up / down
+    query            height requests and anything unknown
+
+The class comes from the command's name in the "commands" section of
+config.json; only an emergency stop has to be asked for. A stop drops the
+motion commands still queued, a motion command replaces a queued one, and a
+write identical to one already queued is not queued again: both callers
+wait for the same write. Repeats of the move the desk is already making
+and queries are spaced at least 1 / max_writes_per_s apart ("dispatch"
+section); a stop, or a move that starts or reverses the desk, is never held
+back by the cap, since any delay there turns into a height error.
+
+With a timer (a StageTimer) the time each write waited in the queue goes
+into a "queue_<class>" histogram and the time until the client returned
+(the write response, for writes with response=True) into "ack".
+"""
+
+import asyncio
+from collections import deque
+from typing import Deque, List, Optional
+
+from desk_telemetry import now_ns
+
+PRIORITY_EMERGENCY = 0
+PRIORITY_STOP = 1
+PRIORITY_MOTION = 2
+PRIORITY_QUERY = 3
+PRIORITY_NAMES = ("emergency", "stop", "motion", "query")
+
+COMMAND_PRIORITIES = {
+    "stop": PRIORITY_STOP,
+    "move_up": PRIORITY_MOTION,
+    "move_down": PRIORITY_MOTION,
+    "fetch_height": PRIORITY_QUERY,
+}
+
+DEFAULT_DISPATCH_PARAMS = {
+    "max_writes_per_s": 50.0,   # Move repeats and queries; 0 = unlimited
+}
+
+
+class QueuedWrite:
+    """A write waiting in the queue, shared by every caller that asked for it."""
+    __slots__ = ("char_specifier", "data", "response", "enqueued_ns", "done", "waiters")
+
+    def __init__(self, char_specifier, data: bytes, response: bool, done: asyncio.Future):
+        self.char_specifier = char_specifier
+        self.data = data
+        self.response = response
+        self.enqueued_ns = now_ns()
+        self.done = done
+        self.waiters = 1
+
+    def same_as(self, char_specifier, data: bytes, response: bool) -> bool:
+        return self.data == data and self.char_specifier == char_specifier and self.response == response
+
+
+class CommandDispatcher:
+    """Wraps a client so all its writes go through one priority queue; everything else is passed through."""
+    def __init__(self, client, config: dict, timer=None):
+        self._client = client
+        params = dict(DEFAULT_DISPATCH_PARAMS)
+        params.update(config.get("dispatch", {}))
+        max_rate = params["max_writes_per_s"]
+        self.min_interval_ns = int(1e9 / max_rate) if max_rate else 0
+        self.priorities = {bytes.fromhex(cmd): COMMAND_PRIORITIES.get(name, PRIORITY_QUERY)
+                           for name, cmd in config.get("commands", {}).items()}
+        self.timer = timer
+        self.queues: List[Deque[QueuedWrite]] = [deque() for _ in PRIORITY_NAMES]
+        self.written = 0
+        self.collapsed = 0          # Writes that joined an identical queued one
+        self.dropped = 0            # Queued moves dropped by a stop or replaced by another move
+        self.max_depth = 0
+        self._last_issued_ns: Optional[int] = None
+        self._moving: Optional[bytes] = None    # Last move written since the last stop
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def priority(self, data) -> int:
+        return self.priorities.get(bytes(data), PRIORITY_QUERY)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "written": self.written,
+            "collapsed": self.collapsed,
+            "dropped": self.dropped,
+        }
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False, priority: Optional[int] = None):
+        """
+        Queues a write and waits until the client has taken it. Returns
+        False if it was dropped before being sent.
+        """
+        data = bytes(data)
+        if priority is None:
+            priority = self.priority(data)
+        if priority <= PRIORITY_STOP:
+            self._drop(PRIORITY_MOTION)
+        if priority == PRIORITY_EMERGENCY:
+            await self._write(char_specifier, data, response, now_ns(), priority)
+            return True
+
+        queue = self.queues[priority]
+        entry = next((q for q in queue if q.same_as(char_specifier, data, response)), None)
+        if entry is not None:
+            entry.waiters += 1
+            self.collapsed += 1
+        else:
+            if priority == PRIORITY_MOTION:
+                self._drop(PRIORITY_MOTION)
+            entry = QueuedWrite(char_specifier, data, response, asyncio.get_running_loop().create_future())
+            queue.append(entry)
+            self.max_depth = max(self.max_depth, self.depth())
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        elif self._wake is not None:
+            self._wake.set()
+
+        try:
+            return await asyncio.shield(entry.done)
+        except asyncio.CancelledError:
+            # Nobody waits for it any more: do not send it.
+            entry.waiters -= 1
+            if entry.waiters == 0 and entry in queue:
+                queue.remove(entry)
+                entry.done.cancel()
+            raise
+
+    def _drop(self, priority: int):
+        queue = self.queues[priority]
+        while queue:
+            entry = queue.popleft()
+            if not entry.done.done():
+                entry.done.set_result(False)
+            self.dropped += 1
+
+    def _rate_limited(self, priority: int) -> bool:
+        if priority == PRIORITY_MOTION:
+            return self.queues[priority][0].data == self._moving
+        return priority == PRIORITY_QUERY
+
+    async def _write(self, char_specifier, data: bytes, response: bool, enqueued_ns: int, priority: int):
+        issued_ns = now_ns()
+        self._last_issued_ns = issued_ns
+        if priority <= PRIORITY_STOP:
+            self._moving = None
+        elif priority == PRIORITY_MOTION:
+            self._moving = data
+        await self._client.write_gatt_char(char_specifier, data, response=response)
+        self.written += 1
+        if self.timer is not None:
+            self.timer.observe(f"queue_{PRIORITY_NAMES[priority]}", issued_ns - enqueued_ns)
+            self.timer.observe("ack", now_ns() - issued_ns)
+
+    async def _sleep(self, delay_s: float):
+        """Sleeps delay_s, or until a new write wakes the task."""
+        handle = asyncio.get_running_loop().call_later(delay_s, self._wake.set)
+        try:
+            await self._wake.wait()
+        finally:
+            handle.cancel()
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        while True:
+            self._wake.clear()
+            priority = next((p for p, queue in enumerate(self.queues) if queue), None)
+            if priority is None:
+                return
+            if self._last_issued_ns is not None and self._rate_limited(priority):
+                wait_ns = self._last_issued_ns + self.min_interval_ns - now_ns()
+                if wait_ns > 0:
+                    # A stop arriving meanwhile wakes the loop and goes first.
+                    await self._sleep(wait_ns / 1e9)
+                    continue
+            entry = self.queues[priority].popleft()
+            try:
+                await self._write(entry.char_specifier, entry.data, entry.response, entry.enqueued_ns, priority)
+            except Exception as e:
+                entry.done.set_exception(e)
+                if entry.waiters == 0:
+                    entry.done.exception()  # Mark it retrieved
+                continue
+            entry.done.set_result(True)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Connection management for an always-on desk controller.
+
+ConnectionSupervisor watches for link loss through Bleak's disconnected
+callback, reconnects with exponential backoff and jitter, and re-runs the
+connect sequence (wake, re-subscribe, re-read height). run() executes a
+move and, if the link drops while it is running, resumes it from the
+current position once the desk is back. If reconnecting fails
+max_attempts times the supervisor gives up: `failure` says why, the
+context is asked to quit and run() raises ConnectionError.
+"""
+
+import asyncio
+import random
+
+from desk_control import wait_event
+
+DEFAULT_RECONNECT_PARAMS = {
+    "base_delay_s": 0.5,
+    "max_delay_s": 30.0,
+    "max_attempts": 20,         # 0 = retry forever
+}
+
+
+class ConnectionSupervisor:
+    """
+    Keeps one client connected. create_client(disconnected_callback) builds
+    the client once; connect(client) runs the full connect sequence on it and
+    is called again after every link loss.
+    """
+    def __init__(self, context, create_client, connect, params: dict = None):
+        self.context = context
+        self.params = dict(DEFAULT_RECONNECT_PARAMS)
+        self.params.update(params or {})
+
+        self.connected = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.closing = False
+        self.failure = None         # Why the supervisor gave up reconnecting
+        self._watch_task = None
+        self.client = create_client(self.on_disconnect)
+        self._connect = lambda: connect(self.client)
+
+        self.reconnects = 0
+        self.reconnect_latencies_s = []
+
+    def on_disconnect(self, client):
+        """Bleak disconnected_callback."""
+        self.connected.clear()
+        if not self.closing:
+            self.lost.set()
+
+    async def start(self):
+        """Makes the first connection and starts watching for link loss."""
+        await self._connect()
+        self.connected.set()
+        self._watch_task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        self.closing = True
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+
+    def backoff_s(self, attempt: int) -> float:
+        """Exponential backoff with +/-50% jitter."""
+        delay = min(self.params["max_delay_s"], self.params["base_delay_s"] * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _watch(self):
+        while not self.closing:
+            await self.lost.wait()
+            await self.reconnect()
+
+    async def reconnect(self) -> bool:
+        with self.context.timer.span("reconnect"):
+            return await self._reconnect()
+
+    async def _reconnect(self) -> bool:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        max_attempts = self.params["max_attempts"]
+        attempt = 0
+        # The cached height is stale until the desk reports again.
+        self.context.clear_height()
+        self.context.reassembler.reset()
+        while not self.closing:
+            self.context.set_status(f"Connection lost. Reconnecting (attempt {attempt + 1})...")
+            try:
+                await self._connect()
+            except Exception as e:
+                attempt += 1
+                try:
+                    await self.client.disconnect()
+                except Exception:
+                    pass
+                if max_attempts and attempt >= max_attempts:
+                    self.failure = f"Reconnect failed after {attempt} attempts: {e}"
+                    self.closing = True
+                    self.context.request_quit(self.failure)
+                    return False
+                await asyncio.sleep(self.backoff_s(attempt - 1))
+                continue
+            self.lost.clear()
+            self.connected.set()
+            self.reconnects += 1
+            self.reconnect_latencies_s.append(loop.time() - started)
+            self.context.set_status(f"Reconnected in {self.reconnect_latencies_s[-1]:.2f} s.")
+            return True
+        return False
+
+    async def _wait_connected(self) -> bool:
+        while not self.connected.is_set():
+            if self.closing or self.context.should_quit():
+                return False
+            await wait_event(self.connected, 0.1)
+        return True
+
+    async def run(self, make_move):
+        """
+        Runs make_move() to completion, restarting it after every reconnect
+        if the link drops while it is in flight. Returns its result, or None
+        if it was cancelled or the user quit; raises ConnectionError if the
+        supervisor gave up reconnecting.
+        """
+        while True:
+            if not await self._wait_connected():
+                if self.failure is not None:
+                    raise ConnectionError(self.failure)
+                return None
+            move = asyncio.create_task(make_move())
+            lost = asyncio.create_task(self.lost.wait())
+            await asyncio.wait({move, lost}, return_when=asyncio.FIRST_COMPLETED)
+            lost.cancel()
+
+            if move.done() and not self.lost.is_set():
+                if move.cancelled():
+                    return None
+                if move.exception() is None or self.client.is_connected:
+                    return move.result()
+                # A write failed before Bleak reported the disconnect.
+                self.on_disconnect(self.client)
+
+            # The link dropped mid-move: stop the task and resume after reconnecting.
+            move.cancel()
+            try:
+                await move
+            except (asyncio.CancelledError, Exception):
+                pass
+            if self.failure is not None:
+                raise ConnectionError(self.failure)
+            if self.context.should_quit():
+                return None
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Motion estimation for the desk controller.
+
+HeightFilter is a constant-acceleration Kalman filter over the timestamped
+height samples in a HeightRing. The raw readings are whole millimetres,
+arrive at irregular intervals (mostly only when the height changes) and can
+flicker by a millimetre at rest. The filter gives position, velocity and
+acceleration with their uncertainty, catching up on new samples lazily
+whenever it is read, so the notification handler does no extra work. A
+moving desk changes its reading several times a second, so max_gap_s
+without a change means it is at rest: the filter then holds the last
+reading with zero velocity until the reading changes again.
+CoastPredictor uses that velocity to predict how far the desk will keep
+moving after a stop command:
+
+    coast_mm = v * stop_dead_time_s + v^2 / (2 * decel_mm_s2)
+
+When no deceleration has been calibrated it falls back to the fixed
+overshoot_mm_up / overshoot_mm_down offsets.
+
+Coast changes with extension (motor load, gas-spring assist), so autotune
+can also store overshoot_table_up/down (and decel_table_up/down):
+[[height_mm, value], ...] measured across the height range. The table
+gives the shape over height and the scalar gives the level: a value is
+table(height) shifted by (scalar - table mean), which is zero right after
+autotune and follows the online learner afterwards.
+
+MotorModel is the step response fitted by `autotune.py sysid` (the
+"motor_model" config section): the desk starts moving start_dead_time_s after
+a move command, accelerates at accel_mm_s2 up to cruise_mm_s, keeps driving
+stop_dead_time_s after stop and then brakes at decel_mm_s2.
+
+NudgeCurve is the pulse length to travel curve measured by `autotune.py
+nudge` (nudge_curve_up/down), inverted to size a single corrective pulse
+for the remaining error.
+
+OvershootLearner refines those tuning values after every move from the
+coast actually observed once the desk settles (an exponentially weighted
+moving average per direction) and keeps them in a small learned-state
+file, written atomically.
+"""
+
+import json
+import os
+from bisect import bisect_right
+from typing import List, NamedTuple, Optional, Sequence
+
+from desk_telemetry import HeightRing, now_ns
+
+
+DEFAULT_FILTER_PARAMS = {
+    "noise_mm": 0.5,            # Reading noise: quantisation plus the odd +-1 mm flicker
+    "jerk_psd": 1000.0,         # Process noise, spectral density of jerk in mm^2/s^5
+    "max_gap_s": 0.3,           # No change in the reading for this long: the desk is at rest
+    "initial_speed_sd": 50.0,   # Uncertainty of the speed when (re)starting, mm/s
+    "initial_accel_sd": 200.0,  # ...and of the acceleration, mm/s^2
+}
+
+
+class FilteredHeight(NamedTuple):
+    t_ns: int                   # Time of the newest sample the estimate includes
+    position_mm: float
+    velocity_mm_s: float
+    accel_mm_s2: float
+    position_sd_mm: float
+    velocity_sd_mm_s: float
+
+
+class HeightFilter:
+    """Constant-acceleration Kalman filter reading a HeightRing."""
+    def __init__(self, ring: HeightRing, params: Optional[dict] = None):
+        self.ring = ring
+        self.params = dict(DEFAULT_FILTER_PARAMS)
+        self.params.update(params or {})
+        self.seq = 0                    # Next ring sample to fold in
+        self.t_ns: Optional[int] = None
+        self.changed_ns = 0             # When the reading last changed
+        self.last_mm = 0                # Newest reading, held once the desk is at rest
+        self.at_rest = False
+        self.x = [0.0, 0.0, 0.0]        # position, velocity, acceleration
+        self.p = [[0.0] * 3 for _ in range(3)]
+
+    def _restart(self, t_ns: int, height_mm: float):
+        self.t_ns = t_ns
+        self.at_rest = False
+        self.x = [float(height_mm), 0.0, 0.0]
+        noise, speed_sd, accel_sd = (self.params["noise_mm"], self.params["initial_speed_sd"],
+                                     self.params["initial_accel_sd"])
+        self.p = [[noise ** 2, 0.0, 0.0], [0.0, speed_sd ** 2, 0.0], [0.0, 0.0, accel_sd ** 2]]
+
+    def _rest(self):
+        if not self.at_rest:
+            self._restart(self.t_ns, self.last_mm)
+            self.at_rest = True
+
+    def _predict(self, dt: float):
+        x, p, q = self.x, self.p, self.params["jerk_psd"]
+        f = [[1.0, dt, dt * dt / 2], [0.0, 1.0, dt], [0.0, 0.0, 1.0]]
+        self.x = [x[0] + dt * x[1] + dt * dt / 2 * x[2], x[1] + dt * x[2], x[2]]
+        fp = [[sum(f[i][k] * p[k][j] for k in range(3)) for j in range(3)] for i in range(3)]
+        fpf = [[sum(fp[i][k] * f[j][k] for k in range(3)) for j in range(3)] for i in range(3)]
+        # White jerk integrated over dt
+        d2, d3, d4, d5 = dt ** 2, dt ** 3, dt ** 4, dt ** 5
+        noise = [[d5 / 20, d4 / 8, d3 / 6], [d4 / 8, d3 / 3, d2 / 2], [d3 / 6, d2 / 2, dt]]
+        self.p = [[fpf[i][j] + q * noise[i][j] for j in range(3)] for i in range(3)]
+
+    def _update(self, height_mm: float):
+        p = self.p
+        s = p[0][0] + self.params["noise_mm"] ** 2
+        k = [p[0][0] / s, p[1][0] / s, p[2][0] / s]
+        innovation = height_mm - self.x[0]
+        self.x = [self.x[i] + k[i] * innovation for i in range(3)]
+        self.p = [[p[i][j] - k[i] * p[0][j] for j in range(3)] for i in range(3)]
+
+    def add(self, t_ns: int, height_mm: float):
+        """Folds in one sample; normally done by catch_up() from the ring."""
+        held_mm, self.last_mm = self.last_mm, height_mm
+        if self.t_ns is None:
+            self._restart(t_ns, height_mm)
+            self.changed_ns = t_ns
+            return
+        resting = (t_ns - self.changed_ns) / 1e9 > self.params["max_gap_s"]
+        if height_mm != held_mm:
+            self.changed_ns = t_ns
+        elif resting:
+            self._rest()
+            return
+        if resting:
+            # Starting from rest at the held reading; this sample is weighed like any other.
+            self._restart(t_ns, held_mm)
+        elif t_ns > self.t_ns:
+            self._predict((t_ns - self.t_ns) / 1e9)
+            self.t_ns = t_ns
+        self._update(height_mm)
+
+    def catch_up(self):
+        """Folds in every ring sample written since the last call."""
+        if self.ring.count < self.seq:
+            # The ring was reset: the height is unknown again.
+            self.seq = 0
+            self.t_ns = None
+        t_ns, heights = self.ring.since(self.seq)
+        for t, h in zip(t_ns, heights):
+            self.add(t, h)
+        self.seq = self.ring.count
+
+    def state(self) -> Optional[FilteredHeight]:
+        """Estimate as of the newest sample, None while the height is unknown."""
+        self.catch_up()
+        if self.t_ns is None:
+            return None
+        if (now_ns() - self.changed_ns) / 1e9 > self.params["max_gap_s"]:
+            self._rest()
+        p = self.p
+        return FilteredHeight(self.t_ns, self.x[0], self.x[1], self.x[2],
+                              max(p[0][0], 0.0) ** 0.5, max(p[1][1], 0.0) ** 0.5)
+
+    def position_mm(self) -> float:
+        """Filtered height, 0.0 while unknown."""
+        estimate = self.state()
+        return 0.0 if estimate is None else estimate.position_mm
+
+    def velocity(self) -> float:
+        """Returns mm/s (positive = up), 0.0 while unknown."""
+        estimate = self.state()
+        return 0.0 if estimate is None else estimate.velocity_mm_s
+
+
+class HeightTable:
+    """Piecewise-linear function of height from [[height_mm, value], ...], clamped at both ends."""
+    def __init__(self, points: Sequence[Sequence[float]]):
+        points = sorted((float(h), float(v)) for h, v in points)
+        self.heights: List[float] = [h for h, _ in points]
+        self.values: List[float] = [v for _, v in points]
+        self.mean = sum(self.values) / len(self.values)
+
+    def __call__(self, height_mm: float) -> float:
+        i = bisect_right(self.heights, height_mm)
+        if i == 0:
+            return self.values[0]
+        if i == len(self.heights):
+            return self.values[-1]
+        h0, h1 = self.heights[i - 1], self.heights[i]
+        v0, v1 = self.values[i - 1], self.values[i]
+        return v0 + (v1 - v0) * (height_mm - h0) / (h1 - h0)
+
+
+def _table(params: dict, key: str) -> Optional[HeightTable]:
+    points = params.get(key)
+    return HeightTable(points) if points else None
+
+
+class CoastPredictor:
+    """Predicts the resting point after a stop for one direction of travel."""
+    def __init__(self, direction: str, params: dict):
+        self.direction = direction
+        key = direction.lower()
+        self.fixed_overshoot_mm = params[f"overshoot_mm_{key}"]
+        self.decel_mm_s2: Optional[float] = params.get(f"decel_mm_s2_{key}") or None
+        self.dead_time_s = params.get("stop_dead_time_s", 0.0)
+        self.overshoot_table = _table(params, f"overshoot_table_{key}")
+        self.decel_table = _table(params, f"decel_table_{key}")
+
+    def overshoot_at(self, height_mm: float) -> float:
+        """Fixed-mode coast at a height: the table's shape at the scalar's level."""
+        if self.overshoot_table is None:
+            return self.fixed_overshoot_mm
+        return self.overshoot_table(height_mm) + self.fixed_overshoot_mm - self.overshoot_table.mean
+
+    def decel_at(self, height_mm: float) -> Optional[float]:
+        if self.decel_table is None or not self.decel_mm_s2 or self.decel_table.mean <= 0:
+            return self.decel_mm_s2
+        return self.decel_table(height_mm) * self.decel_mm_s2 / self.decel_table.mean
+
+    def overshoot_level(self, height_mm: float, coast_mm: float) -> float:
+        """The overshoot scalar that makes overshoot_at(height_mm) equal coast_mm."""
+        if self.overshoot_table is None:
+            return coast_mm
+        return coast_mm - self.overshoot_table(height_mm) + self.overshoot_table.mean
+
+    def decel_level(self, height_mm: float, decel_mm_s2: float) -> float:
+        """The deceleration scalar that makes decel_at(height_mm) equal decel_mm_s2."""
+        if self.decel_table is None or self.decel_table.mean <= 0 or self.decel_table(height_mm) <= 0:
+            return decel_mm_s2
+        return decel_mm_s2 * self.decel_table.mean / self.decel_table(height_mm)
+
+    def coast_mm(self, speed_mm_s: float, height_mm: Optional[float] = None) -> float:
+        """Expected travel after stop at the given (absolute) speed, at height_mm if known."""
+        if not self.decel_mm_s2 or speed_mm_s <= 0:
+            return self.fixed_overshoot_mm if height_mm is None else self.overshoot_at(height_mm)
+        decel = self.decel_mm_s2 if height_mm is None else self.decel_at(height_mm)
+        return speed_mm_s * self.dead_time_s + speed_mm_s ** 2 / (2.0 * decel)
+
+    def should_stop(self, height_mm: float, velocity_mm_s: float, target_mm: float) -> bool:
+        """True once the predicted resting point reaches the target."""
+        # The table is indexed by where the desk will stop, which is close to the target.
+        if self.direction == "UP":
+            return height_mm + self.coast_mm(max(velocity_mm_s, 0.0), target_mm) >= target_mm
+        return height_mm - self.coast_mm(max(-velocity_mm_s, 0.0), target_mm) <= target_mm
+
+    def decel_from_stop(self, speed_mm_s: float, coast_mm: float) -> Optional[float]:
+        """Deceleration implied by one observed stop, None if it can't be determined."""
+        braking_mm = coast_mm - speed_mm_s * self.dead_time_s
+        if speed_mm_s <= 0 or braking_mm <= 0:
+            return None
+        return speed_mm_s ** 2 / (2.0 * braking_mm)
+
+
+class NudgeCurve:
+    """Travel per pulse length for one direction, from [[pulse_s, travel_mm], ...]."""
+    def __init__(self, points: Sequence[Sequence[float]]):
+        # Keep the shortest pulse for each distance, so the inverse is strictly increasing.
+        kept = []
+        for pulse_s, travel_mm in sorted((float(s), float(mm)) for s, mm in points):
+            if travel_mm > (kept[-1][1] if kept else 0.0):
+                kept.append((pulse_s, travel_mm))
+        if not kept:
+            raise ValueError("nudge curve has no pulse that moved the desk")
+        self.points = kept
+        self._inverse = HeightTable([(mm, s) for s, mm in kept])
+
+    @classmethod
+    def load(cls, params: dict, direction: str) -> Optional["NudgeCurve"]:
+        points = params.get(f"nudge_curve_{direction.lower()}")
+        return cls(points) if points else None
+
+    def pulse_s(self, error_mm: float) -> float:
+        """Pulse expected to move error_mm, clamped to the measured range."""
+        return self._inverse(abs(error_mm))
+
+
+class MotorModel:
+    """Fitted step response for one direction of travel."""
+    def __init__(self, direction: str, params: dict):
+        self.direction = direction
+        key = direction.lower()
+        self.start_dead_time_s = params[f"start_dead_time_s_{key}"]
+        self.accel_mm_s2 = params[f"accel_mm_s2_{key}"]
+        self.cruise_mm_s = params[f"cruise_mm_s_{key}"]
+        self.stop_dead_time_s = params[f"stop_dead_time_s_{key}"]
+        self.decel_mm_s2 = params[f"decel_mm_s2_{key}"]
+
+    @classmethod
+    def load(cls, config: dict, direction: str) -> Optional["MotorModel"]:
+        """Model from the "motor_model" config section, None until sysid has written one."""
+        params = config.get("motor_model")
+        if not params or f"cruise_mm_s_{direction.lower()}" not in params:
+            return None
+        return cls(direction, params)
+
+    def powered_s(self, drive_s: float) -> float:
+        """How long the motor pushes when a move command is held drive_s and then stopped."""
+        return max(0.0, drive_s + self.stop_dead_time_s - self.start_dead_time_s)
+
+    def travel_mm(self, drive_s: float) -> float:
+        """Distance from rest to rest for a move command held drive_s, then stop."""
+        powered_s = self.powered_s(drive_s)
+        ramp_s = self.cruise_mm_s / self.accel_mm_s2
+        if powered_s < ramp_s:
+            speed = self.accel_mm_s2 * powered_s
+            driven = 0.5 * speed * powered_s
+        else:
+            speed = self.cruise_mm_s
+            driven = speed * (powered_s - 0.5 * ramp_s)
+        return driven + speed ** 2 / (2.0 * self.decel_mm_s2)
+
+
+DEFAULT_LEARNING_PARAMS = {
+    "enabled": True,
+    "path": "learned_state.json",
+    "alpha": 0.3,               # Weight of the newest observation
+    "min_speed_mm_s": 20.0,     # Ignore stops made before the desk reached speed
+    "max_coast_mm": 60,         # Ignore implausible observations
+}
+
+_LEARNED_KEYS = ("overshoot_mm_up", "overshoot_mm_down", "decel_mm_s2_up", "decel_mm_s2_down")
+_BASE_KEYS = _LEARNED_KEYS + ("overshoot_table_up", "overshoot_table_down", "decel_table_up", "decel_table_down")
+
+
+class OvershootLearner:
+    """
+    EWMA of the observed coast (and, once calibrated, deceleration) per
+    direction, layered over tuning_params. The state remembers the tuning
+    values it started from and is discarded when they change, e.g. after
+    autotune saves new ones.
+    """
+    def __init__(self, params: dict, tuning_params: dict):
+        self.params = params
+        self.base = {k: tuning_params.get(k) for k in _BASE_KEYS}
+        self.learned = {}
+        self.samples = {"up": 0, "down": 0}
+
+    @classmethod
+    def load(cls, config: dict) -> Optional["OvershootLearner"]:
+        """Learner for the "learning" config section, None unless enabled."""
+        params = dict(DEFAULT_LEARNING_PARAMS)
+        params.update(config.get("learning", {}))
+        if not params["enabled"]:
+            return None
+        learner = cls(params, config["tuning_params"])
+        try:
+            with open(params["path"], "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return learner
+        if state.get("base") == learner.base:
+            learner.learned = state.get("learned", {})
+            learner.samples.update(state.get("samples", {}))
+        return learner
+
+    def tuning(self, tuning_params: dict) -> dict:
+        """tuning_params with the learned values applied."""
+        merged = dict(tuning_params)
+        merged.update(self.learned)
+        return merged
+
+    def _update(self, key: str, observed: float, digits: int):
+        current = self.learned.get(key, self.base[key])
+        if current is None:
+            current = observed
+        self.learned[key] = round(current + self.params["alpha"] * (observed - current), digits)
+
+    def observe(self, predictor: CoastPredictor, speed_mm_s: float, coast_mm: float,
+                height_mm: Optional[float] = None) -> bool:
+        """
+        Folds in one stop (speed when stop was sent, distance travelled
+        after, at height_mm if known). False if rejected.
+        """
+        if speed_mm_s < self.params["min_speed_mm_s"] or not 0 <= coast_mm <= self.params["max_coast_mm"]:
+            return False
+        key = predictor.direction.lower()
+        # The scalars are the level of the height tables, so take the table's shape at this height back out.
+        level_mm = coast_mm if height_mm is None else predictor.overshoot_level(height_mm, coast_mm)
+        self._update(f"overshoot_mm_{key}", level_mm, 1)
+        decel = predictor.decel_from_stop(speed_mm_s, coast_mm)
+        # Only refine a deceleration autotune has calibrated; don't switch modes behind the user's back.
+        if decel and self.base[f"decel_mm_s2_{key}"]:
+            if height_mm is not None:
+                decel = predictor.decel_level(height_mm, decel)
+            self._update(f"decel_mm_s2_{key}", decel, 1)
+        self.samples[key] += 1
+        return True
+
+    def save(self):
+        """Writes the state to a temporary file and renames it over the old one."""
+        path = self.params["path"]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"base": self.base, "learned": self.learned, "samples": self.samples}, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
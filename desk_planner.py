@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Model-predictive move planning from the motor model fitted by
+`autotune.py sysid`.
+
+The staged loop stops on the first height sample whose predicted resting
+point passes the target, so its stop lands up to one notification interval
+late. The planner instead predicts where the desk would come to rest if stop
+were sent at any moment, and schedules stop for the moment that lands on
+the target. drive_until_deadline() re-evaluates that moment on every height
+sample from the measured height and velocity, so model error is corrected as
+the move goes, and the stop can fall between two samples.
+
+A move too short to reach a measurable speed has no samples worth
+re-planning on, so it is sent as one timed pulse. The remaining error after
+settling is corrected the same way. Drive times come from a table of
+rest-to-rest travel per drive time, computed once per move, so planning
+costs a bisection per sample.
+"""
+
+from bisect import bisect_right
+from typing import List, Optional
+
+from desk_model import MotorModel
+from desk_telemetry import now_ns
+
+DEFAULT_PLANNER_PARAMS = {
+    "enabled": True,            # Plan moves whenever sysid has written a motor_model
+    "table_step_s": 0.005,      # Drive time resolution of the travel table
+    "min_closed_loop_s": 0.5,   # Shorter drives are sent open loop, as a single pulse
+    "min_speed_ratio": 0.5,     # Re-plan from samples once this fraction of cruise is reached
+}
+# Bisection steps for the stop time; 2^-40 of the search interval is far below a BLE write.
+_BISECT_STEPS = 40
+
+
+def planner_params(config: dict) -> dict:
+    params = dict(DEFAULT_PLANNER_PARAMS)
+    params.update(config.get("planner", {}))
+    return params
+
+
+class MovePlanner:
+    """Stop and pulse timing for one direction of travel."""
+    def __init__(self, model: MotorModel, params: dict):
+        self.model = model
+        self.params = params
+        self.drive_table: List[float] = []
+        self.travel_table: List[float] = []
+        # Past the ramp, travel grows by cruise_mm_s per second of drive; the table stops there.
+        step_s = params["table_step_s"]
+        end_s = model.start_dead_time_s + model.cruise_mm_s / model.accel_mm_s2 + step_s
+        drive_s = 0.0
+        while drive_s <= end_s:
+            travel_mm = model.travel_mm(drive_s)
+            if travel_mm > (self.travel_table[-1] if self.travel_table else 0.0):
+                self.drive_table.append(drive_s)
+                self.travel_table.append(travel_mm)
+            drive_s += step_s
+
+    @classmethod
+    def load(cls, config: dict, direction: str, tuning: dict) -> Optional["MovePlanner"]:
+        """
+        Planner for the configured motor model, None if there is none or planning
+        is disabled. Calibrated stop parameters in tuning (including what the
+        learner has refined) take precedence over the model's.
+        """
+        params = planner_params(config)
+        model = MotorModel.load(config, direction) if params["enabled"] else None
+        if model is None:
+            return None
+        decel = tuning.get(f"decel_mm_s2_{direction.lower()}")
+        if decel:
+            model.decel_mm_s2 = decel
+        return cls(model, params)
+
+    def drive_s(self, distance_mm: float) -> float:
+        """How long to hold the move command, starting from rest, to travel distance_mm."""
+        if distance_mm <= 0 or not self.travel_table:
+            return 0.0
+        if distance_mm >= self.travel_table[-1]:
+            return self.drive_table[-1] + (distance_mm - self.travel_table[-1]) / self.model.cruise_mm_s
+        i = bisect_right(self.travel_table, distance_mm)
+        if i == 0:
+            return self.drive_table[0]
+        t0, t1 = self.drive_table[i - 1], self.drive_table[i]
+        x0, x1 = self.travel_table[i - 1], self.travel_table[i]
+        return t0 + (t1 - t0) * (distance_mm - x0) / (x1 - x0)
+
+    def is_short(self, distance_mm: float) -> bool:
+        """True if the move is better sent as a single timed pulse."""
+        return self.drive_s(distance_mm) < self.params["min_closed_loop_s"]
+
+    def has_speed(self, speed_mm_s: float) -> bool:
+        """True once the measured speed is good enough to re-plan from."""
+        return speed_mm_s >= self.params["min_speed_ratio"] * self.model.cruise_mm_s
+
+    def travel_after_stop_in(self, stop_in_s: float, speed_mm_s: float) -> float:
+        """Travel from now to rest if stop is sent stop_in_s from now, moving at speed_mm_s."""
+        m = self.model
+        cruise = max(m.cruise_mm_s, speed_mm_s)
+        powered_s = stop_in_s + m.stop_dead_time_s
+        ramp_s = (cruise - speed_mm_s) / m.accel_mm_s2
+        if powered_s < ramp_s:
+            end_speed = speed_mm_s + m.accel_mm_s2 * powered_s
+            driven = (speed_mm_s + end_speed) / 2 * powered_s
+        else:
+            end_speed = cruise
+            driven = (speed_mm_s + cruise) / 2 * ramp_s + cruise * (powered_s - ramp_s)
+        return driven + end_speed ** 2 / (2.0 * m.decel_mm_s2)
+
+    def stop_in_s(self, remaining_mm: float, speed_mm_s: float) -> float:
+        """Seconds from now until stop should be sent to come to rest remaining_mm further on."""
+        if self.travel_after_stop_in(0.0, speed_mm_s) >= remaining_mm:
+            return 0.0
+        low, high = 0.0, 1.0
+        while self.travel_after_stop_in(high, speed_mm_s) < remaining_mm:
+            low, high = high, high * 2
+        for _ in range(_BISECT_STEPS):
+            middle = (low + high) / 2
+            if self.travel_after_stop_in(middle, speed_mm_s) < remaining_mm:
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def deadline(self, context, loop):
+        """
+        deadline() for drive_until_deadline, for a move starting from rest now:
+        the open-loop drive time until the desk has speed, then re-planned
+        from the filtered height and velocity.
+        """
+        sign = 1 if self.model.direction == "UP" else -1
+        open_loop_stop_at = loop.time() + self.drive_s(sign * context.error_mm)
+
+        def stop_at() -> float:
+            estimate = context.motion.state()
+            if estimate is None or not self.has_speed(sign * estimate.velocity_mm_s):
+                return open_loop_stop_at
+            speed_mm_s = sign * estimate.velocity_mm_s
+            # Extrapolate the estimate to now; it may be up to a notification interval old.
+            remaining_mm = sign * (context.target_mm - estimate.position_mm) - speed_mm_s * (now_ns() - estimate.t_ns) / 1e9
+            return loop.time() + self.stop_in_s(remaining_mm, speed_mm_s)
+        return stop_at
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Byte-level codec for the Jiecang BLE desk protocol.
+
+Every packet on the wire has the same layout:
+
+    | header (2) | opcode (1) | length (1) | payload (length) | checksum (1) | 0x7E |
+
+Commands written to the desk use the F1F1 header, notifications coming back
+from the desk use F2F2. The checksum is the low byte of
+opcode + length + sum(payload).
+"""
+
+import struct
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+# --- Frame Layout ---
+COMMAND_HEADER = b"\xf1\xf1"
+NOTIFY_HEADER = b"\xf2\xf2"
+FRAME_TAIL = 0x7E
+FRAME_OVERHEAD = 6          # header(2) + opcode + length + checksum + tail
+
+# --- Opcodes ---
+OP_HEIGHT = 0x01            # Notify: current height in mm (big endian)
+
+_HEADER_BYTE = NOTIFY_HEADER[0]
+
+
+class HeightFrame(NamedTuple):
+    """A decoded F2F2 height report."""
+    height_mm: int
+
+
+class Frame(NamedTuple):
+    """Any other well-formed F2F2 frame."""
+    opcode: int
+    payload: bytes
+
+
+ParsedFrame = Union[HeightFrame, Frame]
+
+# header + opcode + length as one word, height hi, height lo, extra, checksum, tail
+_HEIGHT_STRUCT = struct.Struct(">IBBBBB")
+_HEIGHT_UNPACK = _HEIGHT_STRUCT.unpack_from
+_HEIGHT_LEAD_WORD = int.from_bytes(NOTIFY_HEADER + bytes((OP_HEIGHT, 3)), "big")
+HEIGHT_FRAME_SIZE = _HEIGHT_STRUCT.size
+
+
+def checksum(opcode: int, payload: bytes = b"") -> int:
+    """Returns the checksum byte for an opcode and its payload."""
+    return (opcode + len(payload) + sum(payload)) & 0xFF
+
+
+def build_frame(header: bytes, opcode: int, payload: bytes = b"") -> bytes:
+    """Encodes a complete frame, e.g. build_frame(COMMAND_HEADER, 0x01)."""
+    return header + bytes((opcode, len(payload))) + payload + bytes((checksum(opcode, payload), FRAME_TAIL))
+
+
+def build_height_frame(height_mm: int) -> bytes:
+    """Encodes the height notification the desk sends (used by the simulator)."""
+    return build_frame(NOTIFY_HEADER, OP_HEIGHT, height_mm.to_bytes(2, "big") + b"\x07")
+
+
+def decode_frame(view: memoryview, start: int) -> Tuple[Optional[ParsedFrame], int]:
+    """
+    Tries to decode one F2F2 frame starting at view[start].
+
+    Returns (frame, size) for a valid frame, (None, 0) if the buffer ends
+    before the frame is complete, and (None, -1) if the bytes at start are
+    not a valid frame (bad header, tail or checksum).
+    """
+    available = len(view) - start
+    if available < FRAME_OVERHEAD:
+        return None, 0
+    if view[start] != _HEADER_BYTE or view[start + 1] != _HEADER_BYTE:
+        return None, -1
+
+    opcode = view[start + 2]
+    length = view[start + 3]
+    size = FRAME_OVERHEAD + length
+    if available < size:
+        return None, 0
+
+    body_end = start + 4 + length
+    if view[body_end + 1] != FRAME_TAIL or view[body_end] != sum(view[start + 2:body_end]) & 0xFF:
+        return None, -1
+    if opcode == OP_HEIGHT and length >= 2:
+        return HeightFrame((view[start + 4] << 8) | view[start + 5]), size
+    return Frame(opcode, bytes(view[start + 4:body_end])), size
+
+
+def _unpack_height(data, start: int = 0) -> Optional[int]:
+    """
+    Returns the height if a complete, valid height report starts at
+    data[start]. data must hold at least HEIGHT_FRAME_SIZE bytes from start.
+    """
+    lead, high, low, extra, check, tail = _HEIGHT_UNPACK(data, start)
+    if lead == _HEIGHT_LEAD_WORD and tail == FRAME_TAIL and check == (OP_HEIGHT + 3 + high + low + extra) & 0xFF:
+        return (high << 8) | low
+    return None
+
+
+def parse_frames(data) -> List[ParsedFrame]:
+    """
+    Returns every valid frame in a single notification, skipping any bytes
+    that do not start a well-formed frame. No intermediate strings are built.
+    """
+    end = len(data)
+    # Fast path: the notification is exactly one height report.
+    if end == HEIGHT_FRAME_SIZE:
+        height_mm = _unpack_height(data)
+        if height_mm is not None:
+            return [HeightFrame(height_mm)]
+
+    if not hasattr(data, "find"):
+        data = bytes(data)
+    view = memoryview(data)
+    find = data.find
+    frames = []
+    start = find(NOTIFY_HEADER)
+    while start >= 0:
+        if end - start >= HEIGHT_FRAME_SIZE:
+            height_mm = _unpack_height(view, start)
+            if height_mm is not None:
+                frames.append(HeightFrame(height_mm))
+                start = find(NOTIFY_HEADER, start + HEIGHT_FRAME_SIZE)
+                continue
+        frame, size = decode_frame(view, start)
+        if size > 0:
+            frames.append(frame)
+            start = find(NOTIFY_HEADER, start + size)
+        else:
+            start = find(NOTIFY_HEADER, start + 1)
+    return frames
+
+
+def parse_height(data) -> Optional[int]:
+    """Returns the height (mm) from the first height frame in data, or None."""
+    for frame in parse_frames(data):
+        if isinstance(frame, HeightFrame):
+            return frame.height_mm
+    return None
+
+
+class FrameReassembler:
+    """
+    Incremental F2F2 frame decoder for a stream of BLE notifications.
+
+    The controller sometimes splits a frame across two notifications or
+    packs several frames into one. Bytes are appended to a fixed-size
+    buffer and every complete frame is returned as soon as it is available.
+    Bytes that cannot start a valid frame are skipped (resync) and counted.
+    """
+    def __init__(self, capacity: int = 128, max_payload: int = 16):
+        self.capacity = capacity
+        self.max_payload = max_payload
+        self._buf = bytearray(capacity)
+        self._start = 0
+        self._end = 0
+
+        self.frames_decoded = 0
+        self.corrupt_frames = 0      # Started with F2F2 but failed validation
+        self.dropped_bytes = 0       # Garbage skipped during resync or overflow
+
+    def __len__(self):
+        return self._end - self._start
+
+    def reset(self):
+        """Discards any partial frame (e.g. after a reconnect)."""
+        self._start = self._end = 0
+
+    def _append(self, data):
+        size = len(data)
+        if size > self.capacity:
+            self.dropped_bytes += size - self.capacity + (self._end - self._start)
+            data = data[size - self.capacity:]
+            size = self.capacity
+            self._start = self._end = 0
+        elif self._end + size > self.capacity:
+            # Compact the unread bytes to the front, dropping the oldest if still full.
+            pending = self._end - self._start
+            overflow = max(0, pending + size - self.capacity)
+            self.dropped_bytes += overflow
+            keep_from = self._start + overflow
+            pending -= overflow
+            self._buf[0:pending] = self._buf[keep_from:self._end]
+            self._start, self._end = 0, pending
+        self._buf[self._end:self._end + size] = data
+        self._end += size
+
+    def feed(self, data) -> List[ParsedFrame]:
+        """Adds one notification and returns every frame it completed."""
+        # Fast path: nothing buffered (_end is reset to 0 once everything is
+        # consumed) and the notification is one height report.
+        if not self._end and len(data) == HEIGHT_FRAME_SIZE:
+            height_mm = _unpack_height(data)
+            if height_mm is not None:
+                self.frames_decoded += 1
+                return [HeightFrame(height_mm)]
+        self._append(data)
+        frames = []
+        buf = self._buf
+        with memoryview(buf) as whole, whole[:self._end] as view:
+            start = self._start
+            end = self._end
+            while start < end:
+                header = buf.find(NOTIFY_HEADER, start, end)
+                if header < 0:
+                    # Keep a trailing F2 in case the next notification completes the header.
+                    keep = 1 if buf[end - 1] == _HEADER_BYTE else 0
+                    self.dropped_bytes += end - start - keep
+                    start = end - keep
+                    break
+                self.dropped_bytes += header - start
+                start = header
+
+                if end - start > 3 and view[start + 3] > self.max_payload:
+                    frame, size = None, -1
+                else:
+                    frame, size = decode_frame(view, start)
+                if size == 0:
+                    break
+                if size < 0:
+                    self.corrupt_frames += 1
+                    self.dropped_bytes += 1
+                    start += 1
+                    continue
+                frames.append(frame)
+                start += size
+        self._start = start
+        if start == self._end:
+            self._start = self._end = 0
+        self.frames_decoded += len(frames)
+        return frames
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Scan result cache and direct-connect fast path.
+
+BleakClient(address).connect() scans for the desk before every connection,
+which is most of the startup time. CachedBleakClient remembers what a
+successful connection found in a small JSON file (the "scan_cache" section
+of config.json): the device's name, address type and service layout, and
+on BlueZ the D-Bus object path of the device. With that path Bleak connects
+straight to the device without scanning, asking only for the services that
+hold the desk's characteristics. If BlueZ no longer knows the device, the
+connection fails within direct_timeout_s or the characteristics are
+missing, it falls back to a normal scan. Other backends cannot connect
+without a scan, so there every connect scans. Every connect is described in
+`last_connect`, including the time a direct connect saved against the last
+connect that needed a scan.
+
+The write and notify characteristics are resolved once per connect into
+`characteristics`, and callers pass those objects (see characteristic())
+to write_gatt_char and start_notify, so no write has to search the
+services for a UUID.
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Dict, NamedTuple, Optional
+
+from bleak import BleakClient, BleakError, BleakScanner
+from bleak.backends.device import BLEDevice
+
+DEFAULT_SCAN_CACHE_PARAMS = {
+    "enabled": True,
+    "path": "desk_cache.json",
+    "direct_timeout_s": 3.0,    # Before a direct connect gives up and scans
+}
+
+# BlueZ device properties BleakClient reads when it is given a BLEDevice
+BLUEZ_PROPS = ("Address", "AddressType", "Alias", "Adapter")
+
+
+class ConnectReport(NamedTuple):
+    direct: bool                # Connected from the cached device path, without a scan
+    fell_back: bool             # A direct connect failed and a scan followed
+    scan_s: float               # Until the scan found the desk; 0 for a direct connect
+    connect_s: float            # Whole connect, including a failed direct attempt
+    saved_s: Optional[float]    # By a direct connect, against the last scan; None otherwise
+
+
+def service_layout(services) -> dict:
+    """{service_uuid: {char_uuid: {"handle": int, "properties": [...]}}} of a Bleak service collection."""
+    return {
+        service.uuid: {char.uuid: {"handle": char.handle, "properties": list(char.properties)}
+                       for char in service.characteristics}
+        for service in services
+    }
+
+
+def address_type(device) -> Optional[str]:
+    """The address type ("public" or "random") where the backend reports it (BlueZ), else None."""
+    details = device.details if isinstance(device.details, dict) else {}
+    return details.get("props", {}).get("AddressType")
+
+
+def bluez_details(device) -> Optional[dict]:
+    """What BleakClient needs to connect to a BlueZ device without a scan, None on other backends."""
+    details = device.details if isinstance(device.details, dict) else {}
+    if "path" not in details:
+        return None
+    props = details.get("props", {})
+    return {"path": details["path"], "props": {key: props[key] for key in BLUEZ_PROPS if key in props}}
+
+
+class ScanCache:
+    """Devices seen on earlier runs, keyed by upper-case address."""
+    def __init__(self, path: str, devices: dict = None):
+        self.path = path
+        self.devices = devices or {}
+
+    @classmethod
+    def load(cls, path: str) -> "ScanCache":
+        try:
+            with open(path, "r") as f:
+                return cls(path, json.load(f).get("devices", {}))
+        except (FileNotFoundError, ValueError):
+            return cls(path)
+
+    def get(self, address: str) -> Optional[dict]:
+        return self.devices.get(address.upper())
+
+    def put(self, address: str, entry: dict):
+        self.devices[address.upper()] = entry
+
+    def save(self):
+        """Writes the cache to a temporary file and renames it over the old one."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"devices": self.devices}, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class CachedBleakClient:
+    """
+    BleakClient stand-in for the configured desk that connects through the
+    scan cache. A new BleakClient is made for every connect(); everything
+    else is passed through to it.
+    """
+    def __init__(self, config: dict, disconnected_callback=None):
+        self.address = config["device_address"]
+        self.write_uuid = config["write_uuid"]
+        self.notify_uuid = config["notify_uuid"]
+        self.required_uuids = {self.write_uuid.lower(), self.notify_uuid.lower()}
+        self.params = dict(DEFAULT_SCAN_CACHE_PARAMS)
+        self.params.update(config.get("scan_cache", {}))
+        self.disconnected_callback = disconnected_callback
+        self.cache = ScanCache.load(self.params["path"])
+        self.last_connect: Optional[ConnectReport] = None
+        self.characteristics: Dict[str, object] = {}    # Config UUID -> BleakGATTCharacteristic
+        self._client: Optional[BleakClient] = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            raise AttributeError(f"{name} is not available before connect()")
+        return getattr(self._client, name)
+
+    @property
+    def is_connected(self) -> bool:
+        return self._client is not None and self._client.is_connected
+
+    async def connect(self, timeout: float = 10.0, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        entry = self.cache.get(self.address)
+        details = None if entry is None else entry.get("bluez")
+        if details is not None:
+            device = BLEDevice(self.address, entry.get("name"), details)
+            try:
+                layout = await self._connect(device, entry, min(timeout, self.params["direct_timeout_s"]), True)
+            except (asyncio.TimeoutError, BleakError, OSError):
+                # BlueZ has forgotten the device, it is out of reach, or the layout changed: scan for it.
+                await self.disconnect()
+            else:
+                connect_s = loop.time() - started
+                full_connect_s = entry.get("full_connect_s")
+                saved_s = None if full_connect_s is None else max(0.0, full_connect_s - connect_s)
+                self.last_connect = ConnectReport(True, False, 0.0, connect_s, saved_s)
+                self._remember(device, dict(entry["services"], **layout), full_connect_s)
+                return True
+
+        full_started = loop.time()
+        device = await BleakScanner.find_device_by_address(self.address, timeout=timeout)
+        if device is None:
+            raise BleakError(f"Device with address {self.address} was not found.")
+        scan_s = loop.time() - full_started
+        layout = await self._connect(device, entry, timeout, False)
+        now = loop.time()
+        self.last_connect = ConnectReport(False, details is not None, scan_s, now - started, None)
+        self._remember(device, layout, now - full_started)
+        return True
+
+    async def disconnect(self):
+        if self._client is None:
+            return True
+        try:
+            return await self._client.disconnect()
+        except (BleakError, OSError):
+            return False
+
+    async def _connect(self, device, entry: Optional[dict], timeout: float, direct: bool) -> dict:
+        """
+        Connects to device and resolves the desk's characteristics; returns
+        the service layout. direct asks Bleak only for the cached services
+        that hold the characteristics.
+        """
+        services = None
+        if direct:
+            # Only the services holding the desk's characteristics need discovering.
+            services = [uuid for uuid, chars in entry["services"].items() if self.required_uuids & set(chars)]
+        self._client = BleakClient(device, disconnected_callback=self.disconnected_callback, services=services)
+        await self._client.connect(timeout=timeout)
+        layout = service_layout(self._client.services)
+        found = {char_uuid for chars in layout.values() for char_uuid in chars}
+        if not self.required_uuids <= found:
+            raise BleakError(f"Desk characteristics {sorted(self.required_uuids - found)} not found.")
+
+        collection = self._client.services
+        self.characteristics = {uuid: collection.get_characteristic(uuid)
+                                for uuid in (self.write_uuid, self.notify_uuid)}
+        return layout
+
+    def _remember(self, device, layout: dict, full_connect_s: Optional[float]):
+        self.cache.put(self.address, {
+            "name": device.name,
+            "address_type": address_type(device),
+            "bluez": bluez_details(device),
+            "services": layout,
+            "full_connect_s": full_connect_s,
+            "last_seen": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        self.cache.save()
+
+
+def create_bleak_client(config: dict, disconnected_callback=None):
+    """CachedBleakClient for the configured desk, or a plain BleakClient if the cache is disabled."""
+    params = dict(DEFAULT_SCAN_CACHE_PARAMS)
+    params.update(config.get("scan_cache", {}))
+    if params["enabled"]:
+        return CachedBleakClient(config, disconnected_callback)
+    return BleakClient(config["device_address"], disconnected_callback=disconnected_callback)
+
+
+def characteristic(client, uuid: str):
+    """
+    The characteristic object resolved for uuid on the last connect, so
+    writes and subscriptions skip Bleak's UUID lookup. The UUID itself for
+    clients that do not resolve them (the simulator, replay).
+    """
+    characteristics = getattr(client, "characteristics", None)
+    return characteristics.get(uuid, uuid) if characteristics else uuid
+
+
+def connect_report(client) -> Optional[dict]:
+    """The client's last ConnectReport as a dict, None for clients without one (the simulator)."""
+    report = getattr(client, "last_connect", None)
+    return None if report is None else report._asdict()
+
+
+def describe_connect(client) -> str:
+    """How the client connected, to append to a status line; empty without a report."""
+    report = getattr(client, "last_connect", None)
+    if report is None:
+        return ""
+    if report.fell_back:
+        return f" after a full scan in {report.connect_s:.1f} s (the cached device was not reachable directly)"
+    if not report.direct:
+        return f" after a full scan in {report.connect_s:.1f} s"
+    if report.saved_s is None:
+        return f" directly via the cached device in {report.connect_s:.1f} s"
+    return f" directly via the cached device in {report.connect_s:.1f} s, {report.saved_s:.1f} s faster than a full scan"
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+In-process simulated desk for running without hardware.
+
+SimulatedBleakClient implements the part of the BleakClient API the scripts
+use (connect, write_gatt_char, start_notify, stop_notify, disconnect) and
+drives a small motor model: acceleration to a load-dependent cruise speed,
+a dead time after stop, direction-dependent deceleration (coast), a motor
+timeout when move commands are not repeated, and jittered height
+notifications encoded as real F2F2 frames.
+
+Enable it with "simulator": {"enabled": true} in config.json. With
+"virtual_time": true the asyncio loop advances a virtual clock instead of
+sleeping, so whole moves and autotune runs finish faster than real time.
+"""
+
+import asyncio
+import random
+import selectors
+from typing import Callable, Optional
+
+from desk_protocol import COMMAND_HEADER, build_height_frame, checksum, FRAME_TAIL
+
+# --- Command Opcodes (F1F1 frames) ---
+OP_MOVE_UP = 0x01
+OP_MOVE_DOWN = 0x02
+OP_FETCH_HEIGHT = 0x07
+OP_STOP = 0x2B
+
+DEFAULT_SIM_PARAMS = {
+    "enabled": False,
+    "virtual_time": True,
+    "seed": None,
+    "start_mm": None,               # Defaults to the middle of height_limits
+    "speed_mm_s_up": 38.0,          # Cruise speed with no load
+    "speed_mm_s_down": 40.0,
+    "accel_mm_s2": 120.0,
+    "decel_mm_s2_up": 110.0,
+    "decel_mm_s2_down": 80.0,
+    "load_kg": 20.0,                # Slows UP, speeds up DOWN and lengthens its coast
+    "stop_dead_time_s": 0.08,       # Motor keeps driving this long after stop
+    "command_timeout_s": 0.3,       # Motor stops if no move command is repeated
+    "notify_interval_s": 0.05,
+    "notify_jitter_s": 0.02,
+    "split_probability": 0.0,       # Chance a notification is split / merged with the next
+    "flicker_probability": 0.0,     # Chance a notification reads 1 mm off the true height
+    "connect_delay_s": 1.0,
+    "drop_after_s": None,           # Simulate one link loss this long after connecting
+    "step_s": 0.005,                # Physics integration step
+}
+
+
+def simulator_enabled(config: dict) -> bool:
+    return bool(config.get("simulator", {}).get("enabled", False))
+
+
+def sim_params(config: dict) -> dict:
+    params = dict(DEFAULT_SIM_PARAMS)
+    params.update(config.get("simulator", {}))
+    return params
+
+
+class DeskModel:
+    """Point-mass desk driven by a motor with a command timeout."""
+    def __init__(self, params: dict, min_mm: float, max_mm: float):
+        self.params = params
+        self.min_mm = min_mm
+        self.max_mm = max_mm
+        start_mm = params["start_mm"]
+        self.position_mm = float(start_mm if start_mm is not None else (min_mm + max_mm) / 2)
+        self.velocity_mm_s = 0.0
+        self.drive = 0                  # +1 up, -1 down, 0 off
+        self.drive_until = 0.0          # Motor timeout for the last move command
+        self.stop_at: Optional[float] = None
+
+        load = params["load_kg"]
+        self.cruise_up = params["speed_mm_s_up"] * max(0.2, 1.0 - 0.004 * load)
+        self.cruise_down = params["speed_mm_s_down"] * (1.0 + 0.002 * load)
+        self.decel_up = params["decel_mm_s2_up"] * (1.0 + 0.01 * load)
+        self.decel_down = params["decel_mm_s2_down"] * max(0.2, 1.0 - 0.005 * load)
+
+    @property
+    def height_mm(self) -> int:
+        return int(round(self.position_mm))
+
+    @property
+    def is_moving(self) -> bool:
+        return self.drive != 0 or self.velocity_mm_s != 0.0
+
+    def command_move(self, direction: int, now: float):
+        self.drive = direction
+        self.drive_until = now + self.params["command_timeout_s"]
+        self.stop_at = None
+
+    def command_stop(self, now: float):
+        if self.drive and self.stop_at is None:
+            self.stop_at = now + self.params["stop_dead_time_s"]
+
+    def step(self, now: float, dt: float):
+        if self.drive and (now >= self.drive_until or (self.stop_at is not None and now >= self.stop_at)):
+            self.drive = 0
+            self.stop_at = None
+
+        if self.drive > 0:
+            self.velocity_mm_s = min(self.cruise_up, self.velocity_mm_s + self.params["accel_mm_s2"] * dt)
+        elif self.drive < 0:
+            self.velocity_mm_s = max(-self.cruise_down, self.velocity_mm_s - self.params["accel_mm_s2"] * dt)
+        elif self.velocity_mm_s > 0:
+            self.velocity_mm_s = max(0.0, self.velocity_mm_s - self.decel_up * dt)
+        elif self.velocity_mm_s < 0:
+            self.velocity_mm_s = min(0.0, self.velocity_mm_s + self.decel_down * dt)
+
+        self.position_mm += self.velocity_mm_s * dt
+        if not self.min_mm <= self.position_mm <= self.max_mm:
+            self.position_mm = min(self.max_mm, max(self.min_mm, self.position_mm))
+            self.velocity_mm_s = 0.0
+            self.drive = 0
+
+
+class SimulatedBleakClient:
+    """Drop-in replacement for BleakClient talking to a DeskModel."""
+    def __init__(self, config: dict, disconnected_callback: Optional[Callable] = None):
+        self.address = config.get("device_address", "SIMULATED")
+        self.disconnected_callback = disconnected_callback
+        self.params = sim_params(config)
+        limits = config.get("height_limits", {"min_cm": 62.0, "max_cm": 127.0})
+        self.desk = DeskModel(self.params, limits["min_cm"] * 10, limits["max_cm"] * 10)
+        self.rng = random.Random(self.params["seed"])
+
+        self.is_connected = False
+        self.writes = 0
+        self._callback: Optional[Callable] = None
+        self._notify_uuid = None
+        self._task: Optional[asyncio.Task] = None
+        self._drop_at: Optional[float] = None
+        self._fetch_requested = False
+        self._pending = b""
+        self._last_sent_mm: Optional[int] = None
+
+    # --- BleakClient API ---
+
+    async def connect(self, timeout: float = 10.0, **kwargs):
+        await asyncio.sleep(min(timeout, self.params["connect_delay_s"]))
+        self.is_connected = True
+        if self.params["drop_after_s"] is not None:
+            self._drop_at = asyncio.get_running_loop().time() + self.params["drop_after_s"]
+            self.params["drop_after_s"] = None
+        # The desk keeps moving while the link is down, so physics survives a drop.
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return True
+
+    async def disconnect(self):
+        was_connected = self.is_connected
+        self.is_connected = False
+        self._callback = None
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+        return True
+
+    def drop_link(self):
+        """Simulates the link going away (out of range, controller reset...)."""
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        self._callback = None
+        self._pending = b""
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    async def start_notify(self, char_specifier, callback: Callable, **kwargs):
+        self._notify_uuid = char_specifier
+        self._callback = callback
+
+    async def stop_notify(self, char_specifier):
+        self._callback = None
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        if not self.is_connected:
+            raise ConnectionError("Simulated desk is not connected")
+        self.writes += 1
+        data = bytes(data)
+        if len(data) < 6 or data[:2] != COMMAND_HEADER or data[-1] != FRAME_TAIL:
+            return
+        opcode, length = data[2], data[3]
+        if data[4 + length] != checksum(opcode, data[4:4 + length]):
+            return
+
+        now = asyncio.get_running_loop().time()
+        if opcode == OP_MOVE_UP:
+            self.desk.command_move(1, now)
+        elif opcode == OP_MOVE_DOWN:
+            self.desk.command_move(-1, now)
+        elif opcode == OP_STOP:
+            self.desk.command_stop(now)
+        elif opcode == OP_FETCH_HEIGHT:
+            self._fetch_requested = True
+
+    # --- Simulation ---
+
+    def _notify(self, now: float):
+        height_mm = self.desk.height_mm
+        flicker = self.params["flicker_probability"]
+        if flicker and self.rng.random() < flicker:
+            height_mm += self.rng.choice((-1, 1))
+        if not self._fetch_requested and height_mm == self._last_sent_mm:
+            if self._pending and self._callback is not None:
+                self._callback(self._notify_uuid, bytearray(self._pending))
+            self._pending = b""
+            return
+        self._fetch_requested = False
+        self._last_sent_mm = height_mm
+
+        packet = self._pending + build_height_frame(height_mm)
+        self._pending = b""
+        if self.rng.random() < self.params["split_probability"]:
+            cut = self.rng.randrange(1, len(packet))
+            packet, self._pending = packet[:cut], packet[cut:]
+        if self._callback is not None:
+            self._callback(self._notify_uuid, bytearray(packet))
+
+    def _next_notify(self, now: float) -> float:
+        jitter = self.params["notify_jitter_s"]
+        return now + max(0.001, self.params["notify_interval_s"] + self.rng.uniform(-jitter, jitter))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        step_s = self.params["step_s"]
+        last = loop.time()
+        next_notify = self._next_notify(last)
+        while True:
+            await asyncio.sleep(step_s)
+            now = loop.time()
+            self.desk.step(now, now - last)
+            last = now
+            if self._drop_at is not None and now >= self._drop_at:
+                self._drop_at = None
+                self.drop_link()
+            if self.is_connected and (self._fetch_requested or now >= next_notify):
+                self._notify(now)
+                next_notify = self._next_notify(now)
+
+
+# -----------------------------------------------------------------
+# VIRTUAL TIME EVENT LOOP
+# -----------------------------------------------------------------
+
+# Virtual time charged for each loop iteration, so deadlines closer than the
+# loop's clock resolution still expire.
+_VIRTUAL_TICK_S = 1e-6
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """Never blocks: advances the loop's virtual clock by the select timeout instead."""
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0 if timeout is not None else 0.01)
+        if not events and timeout is not None:
+            self.now += max(timeout, _VIRTUAL_TICK_S)
+        return events
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time() jumps straight to the next scheduled callback."""
+    def __init__(self):
+        self._virtual_selector = _VirtualSelector()
+        super().__init__(self._virtual_selector)
+
+    def time(self):
+        return self._virtual_selector.now
+
+
+def run_async(main, config: dict):
+    """asyncio.run(main), on a virtual clock when the simulator asks for it."""
+    params = sim_params(config)
+    if not (params["enabled"] and params["virtual_time"]):
+        return asyncio.run(main)
+    return run_virtual(main)
+
+
+def run_virtual(main):
+    """Runs main to completion on a VirtualTimeEventLoop."""
+    loop = VirtualTimeEventLoop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
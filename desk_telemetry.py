@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Height telemetry shared by the controller, autotune and the UI.
+
+HeightRing is a preallocated ring buffer of (t_ns, height_mm) samples, one
+per parsed height notification. notification_handler is the only writer;
+it fills the slot first and bumps `count` last, so a reader never sees a
+half-written sample and no lock is needed. Timestamps come from the event
+loop clock (time.monotonic on a real loop, the virtual clock under the
+simulator) in nanoseconds.
+
+TelemetryRecorder is an opt-in, append-only log of every notification,
+command write and status change, in fixed 48-byte records so a log can be
+memory-mapped and indexed directly:
+
+    | t_ns (int64) | kind (1) | length (1) | payload (38) |
+
+Payloads longer than 38 bytes continue in the following records with
+FLAG_CONTINUED set in `kind`. read_records() reassembles them.
+replay_telemetry.py feeds a recorded session back through the parser and
+move_task offline.
+"""
+
+import asyncio
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+DEFAULT_RING_CAPACITY = 4096    # ~200 s of notifications at 20 Hz
+
+
+class HeightRing:
+    """Fixed-size (t_ns, height_mm) ring buffer with a single producer."""
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY):
+        self.capacity = capacity
+        self.t_ns = array("q", bytes(8 * capacity))
+        self.height_mm = array("i", bytes(4 * capacity))
+        self.count = 0                  # Samples ever written; also the next sequence number
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def reset(self):
+        """Forgets all samples (the buffer is reused, not reallocated)."""
+        self.count = 0
+
+    def append(self, t_ns: int, height_mm: int):
+        i = self.count % self.capacity
+        self.t_ns[i] = t_ns
+        self.height_mm[i] = height_mm
+        self.count += 1
+
+    @property
+    def latest_mm(self) -> int:
+        """Most recent height, 0 while the buffer is empty."""
+        if not self.count:
+            return 0
+        return self.height_mm[(self.count - 1) % self.capacity]
+
+    def latest(self) -> Optional[Tuple[int, int]]:
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return self.t_ns[i], self.height_mm[i]
+
+    def window(self, n: Optional[int] = None) -> Tuple[array, array]:
+        """
+        The last n samples (all retained ones if n is None), oldest first, as
+        (t_ns, height_mm) arrays. At most two C-level slice copies.
+        """
+        size = len(self)
+        n = size if n is None else max(0, min(n, size))
+        end = self.count % self.capacity
+        start = (self.count - n) % self.capacity
+        if n == 0:
+            return array("q"), array("i")
+        if start < end:
+            return self.t_ns[start:end], self.height_mm[start:end]
+        return (self.t_ns[start:] + self.t_ns[:end],
+                self.height_mm[start:] + self.height_mm[:end])
+
+    def since(self, seq: int) -> Tuple[array, array]:
+        """Samples written since sequence number seq (e.g. an earlier `count`)."""
+        return self.window(self.count - seq)
+
+
+# -----------------------------------------------------------------
+# BINARY RECORDER
+# -----------------------------------------------------------------
+
+REC_SESSION = 1                 # Payload: free text, e.g. "move_smart_cli.py"
+REC_NOTIFY = 2                  # Payload: raw notification bytes
+REC_WRITE = 3                   # Payload: raw command bytes
+REC_STATUS = 4                  # Payload: UTF-8 status text
+REC_MOVE = 5                    # Payload: target height, int32 mm
+FLAG_CONTINUED = 0x80
+
+_RECORD = struct.Struct("<qBB38s")
+RECORD_SIZE = _RECORD.size
+_PAYLOAD_SIZE = 38
+_FILE_MAGIC = b"DESKTLM1"
+_FILE_HEADER = struct.Struct("<8sHH36x")     # magic, version, record size; padded to one record
+_FILE_VERSION = 1
+_MOVE_PAYLOAD = struct.Struct("<i")
+
+DEFAULT_RECORDER_PARAMS = {
+    "enabled": False,
+    "path": "desk_telemetry.bin",
+}
+
+
+class Record(NamedTuple):
+    t_ns: int
+    kind: int
+    payload: bytes
+
+
+def now_ns() -> int:
+    """Event loop clock in nanoseconds (monotonic clock outside a loop)."""
+    try:
+        return int(asyncio.get_running_loop().time() * 1e9)
+    except RuntimeError:
+        return time.monotonic_ns()
+
+
+class TelemetryRecorder:
+    """Appends records to a telemetry log; every run starts a new session."""
+    def __init__(self, path: str, session: str):
+        self.path = path
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, RECORD_SIZE))
+        self._append(REC_SESSION, session.encode())
+
+    def _append(self, kind: int, payload: bytes):
+        t_ns = now_ns()
+        chunks = [payload[i:i + _PAYLOAD_SIZE] for i in range(0, len(payload), _PAYLOAD_SIZE)] or [b""]
+        for n, chunk in enumerate(chunks):
+            self._file.write(_RECORD.pack(t_ns, kind | (FLAG_CONTINUED if n else 0), len(chunk), chunk))
+
+    def notify(self, data):
+        self._append(REC_NOTIFY, bytes(data))
+
+    def write(self, data):
+        self._append(REC_WRITE, bytes(data))
+
+    def status(self, text: str):
+        self._append(REC_STATUS, text.encode())
+
+    def move(self, target_mm: int):
+        """Marks the start of a move; flushes so the previous one can be read while still running."""
+        self._file.flush()
+        self._append(REC_MOVE, _MOVE_PAYLOAD.pack(target_mm))
+
+    def close(self):
+        self._file.close()
+
+
+def open_recorder(config: dict, session: str) -> Optional[TelemetryRecorder]:
+    """Recorder for the "recorder" config section, None unless enabled."""
+    params = dict(DEFAULT_RECORDER_PARAMS)
+    params.update(config.get("recorder", {}))
+    if not params["enabled"]:
+        return None
+    return TelemetryRecorder(params["path"], session)
+
+
+def move_target_mm(record: Record) -> int:
+    return _MOVE_PAYLOAD.unpack(record.payload)[0]
+
+
+def read_records(path: str) -> Iterator[Record]:
+    """Yields the records of a log, with continued payloads joined. A torn last record is ignored."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < RECORD_SIZE:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, record_size = _FILE_HEADER.unpack_from(mm)
+            if magic != _FILE_MAGIC or version != _FILE_VERSION or record_size != RECORD_SIZE:
+                raise ValueError(f"{path} is not a version {_FILE_VERSION} desk telemetry log")
+            end = len(mm) - (len(mm) - RECORD_SIZE) % RECORD_SIZE
+            pending = None
+            for offset in range(RECORD_SIZE, end, RECORD_SIZE):
+                t_ns, kind, length, payload = _RECORD.unpack_from(mm, offset)
+                if kind & FLAG_CONTINUED and pending is not None:
+                    pending = pending._replace(payload=pending.payload + payload[:length])
+                    continue
+                if pending is not None:
+                    yield pending
+                pending = Record(t_ns, kind & ~FLAG_CONTINUED, payload[:length])
+            if pending is not None:
+                yield pending
+
+
+def split_sessions(records) -> List[List[Record]]:
+    """Groups records by session; each list starts with its REC_SESSION record."""
+    sessions = []
+    for record in records:
+        if record.kind == REC_SESSION or not sessions:
+            sessions.append([])
+        sessions[-1].append(record)
+    return sessions
+
+
+class RecordingClient:
+    """Wraps a BleakClient (or the simulator) and records notifications and writes."""
+    def __init__(self, client, recorder: TelemetryRecorder):
+        self._client = client
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        self._recorder.write(data)
+        return await self._client.write_gatt_char(char_specifier, data, response=response)
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        def recording_callback(sender, data):
+            self._recorder.notify(data)
+            callback(sender, data)
+        return await self._client.start_notify(char_specifier, recording_callback, **kwargs)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Per-stage latency instrumentation for the connect-to-settled pipeline.
+
+StageTimer.span(name) times one stage (connect, wake, first_height,
+fast_approach, settle, nudge, ...) in nanoseconds on the event loop clock,
+so simulated runs report simulated time. Spans of the current run are kept
+for the per-run summary; every span is also added to a per-stage
+LatencyHistogram that accumulates across runs in the daemon and the
+benchmark harness.
+"""
+
+import json
+import math
+from contextlib import contextmanager
+from typing import Dict, List, NamedTuple
+
+from desk_telemetry import now_ns
+
+DEFAULT_TIMING_PARAMS = {
+    "summary": True,            # Print the per-run stage summary at exit
+    "json_path": None,          # Also write it as JSON to this file
+}
+
+
+class Span(NamedTuple):
+    name: str
+    start_ns: int
+    duration_ns: int
+
+
+class LatencyHistogram:
+    """Log-scale histogram: BUCKETS_PER_OCTAVE buckets per doubling, from 1 us."""
+    BUCKETS_PER_OCTAVE = 4
+    MIN_NS = 1000
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+
+    def _bucket(self, duration_ns: int) -> int:
+        if duration_ns <= self.MIN_NS:
+            return 0
+        return int(math.log2(duration_ns / self.MIN_NS) * self.BUCKETS_PER_OCTAVE) + 1
+
+    def _upper_ns(self, bucket: int) -> float:
+        return self.MIN_NS * 2 ** (bucket / self.BUCKETS_PER_OCTAVE)
+
+    def add(self, duration_ns: int):
+        b = self._bucket(duration_ns)
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total_ns += duration_ns
+        self.min_ns = duration_ns if self.min_ns is None else min(self.min_ns, duration_ns)
+        self.max_ns = duration_ns if self.max_ns is None else max(self.max_ns, duration_ns)
+
+    def percentile_ns(self, p: float) -> float:
+        """Upper edge of the bucket holding the p-th percentile (at most max_ns)."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * p / 100.0))
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return min(self._upper_ns(b), self.max_ns)
+        return float(self.max_ns)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ns / self.count / 1e6 if self.count else 0.0,
+            "min_ms": (self.min_ns or 0) / 1e6,
+            "p50_ms": self.percentile_ns(50) / 1e6,
+            "p90_ms": self.percentile_ns(90) / 1e6,
+            "p99_ms": self.percentile_ns(99) / 1e6,
+            "max_ms": (self.max_ns or 0) / 1e6,
+        }
+
+
+class StageTimer:
+    """Named spans for one run, plus histograms over every run."""
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.histograms: Dict[str, LatencyHistogram] = {}
+
+    def new_run(self):
+        """Starts a new per-run summary; the histograms keep accumulating."""
+        self.spans = []
+
+    def add(self, name: str, start_ns: int, duration_ns: int):
+        self.spans.append(Span(name, start_ns, duration_ns))
+        self.histograms.setdefault(name, LatencyHistogram()).add(duration_ns)
+
+    def observe(self, name: str, duration_ns: int):
+        """Adds to the histogram only, for events too frequent for the per-run summary."""
+        self.histograms.setdefault(name, LatencyHistogram()).add(duration_ns)
+
+    @contextmanager
+    def span(self, name: str):
+        start = now_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, now_ns() - start)
+
+    def summary(self) -> Dict[str, dict]:
+        """{stage: {"count", "total_ms"}} for the current run, in first-seen order."""
+        stages: Dict[str, dict] = {}
+        for s in self.spans:
+            stage = stages.setdefault(s.name, {"count": 0, "total_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += s.duration_ns / 1e6
+        return stages
+
+    def histogram_summary(self) -> Dict[str, dict]:
+        return {name: h.to_dict() for name, h in self.histograms.items()}
+
+    def format_summary(self) -> str:
+        lines = ["Stage timings:"]
+        for name, stage in self.summary().items():
+            count = f" x{stage['count']}" if stage["count"] > 1 else ""
+            lines.append(f"  {name + count:<20}{stage['total_ms']:10.1f} ms")
+        return "\n".join(lines)
+
+
+def report_run(timer: StageTimer, config: dict):
+    """Prints and/or writes the per-run summary as configured in the "timing" section."""
+    params = dict(DEFAULT_TIMING_PARAMS)
+    params.update(config.get("timing", {}))
+    if not timer.spans:
+        return
+    if params["summary"]:
+        print(timer.format_summary())
+    if params["json_path"]:
+        with open(params["json_path"], "w") as f:
+            json.dump({"stages": timer.summary(),
+                       "spans": [s._asdict() for s in timer.spans]}, f, indent=4)
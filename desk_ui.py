@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Terminal output shared by move_smart_cli.py and autotune.py.
+
+TerminalRenderer keeps a fixed block of lines at the bottom of the
+terminal and, on every frame, rewrites only the lines that differ from the
+previous frame. When stdout is not a TTY (piped, redirected, a systemd
+unit) it writes one timestamped log line per change instead of escape
+codes.
+
+run_renderer() redraws whenever the context's `version` changes, at most
+max_fps times per second, and sleeps on the context's `changed` event in
+between.
+"""
+
+import asyncio
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+# --- ANSI Escape Codes ---
+CURSOR_UP_N = lambda n: f"\033[{n}F"
+CURSOR_DOWN_N = lambda n: f"\033[{n}E"
+CLEAR_LINE = "\033[K"
+
+DEFAULT_MAX_FPS = 20
+
+
+class TerminalRenderer:
+    """Diffed redraw of a fixed block of num_lines lines."""
+    def __init__(self, num_lines: int, stream=None, tty: Optional[bool] = None):
+        self.num_lines = num_lines
+        self.stream = stream if stream is not None else sys.stdout
+        self.tty = self.stream.isatty() if tty is None else tty
+        self._shown: Optional[List[str]] = None
+        self._last_log: Optional[str] = None
+        self._row = 0                   # Cursor row relative to the top of the block
+
+    def start(self):
+        """Reserves the block below the current cursor position."""
+        if self.tty:
+            self.stream.write("\n" * self.num_lines)
+            self.stream.flush()
+            self._row = self.num_lines
+
+    def draw(self, lines: List[str], log_line: str):
+        """Shows a frame: the changed lines on a TTY, log_line otherwise."""
+        if not self.tty:
+            if log_line != self._last_log:
+                self._last_log = log_line
+                self.stream.write(f"[{time.strftime('%H:%M:%S')}] {log_line}\n")
+                self.stream.flush()
+            return
+
+        out = []
+        for i, line in enumerate(lines):
+            if self._shown is not None and self._shown[i] == line:
+                continue
+            if i < self._row:
+                out.append(CURSOR_UP_N(self._row - i))
+            elif i > self._row:
+                out.append(CURSOR_DOWN_N(i - self._row))
+            out.append(f"{line}{CLEAR_LINE}\n")
+            self._row = i + 1
+        if not out:
+            return
+        if self._row < self.num_lines:
+            out.append(CURSOR_DOWN_N(self.num_lines - self._row))
+            self._row = self.num_lines
+        self._shown = list(lines)
+        self.stream.write("".join(out))
+        self.stream.flush()
+
+    def close(self):
+        """Blanks the block and leaves the cursor at its top."""
+        if self.tty:
+            self.stream.write(CURSOR_UP_N(self.num_lines) + f"{CLEAR_LINE}\n" * self.num_lines
+                              + CURSOR_UP_N(self.num_lines))
+            self.stream.flush()
+            self._shown = None
+            self._row = 0
+
+
+async def run_renderer(context, renderer: TerminalRenderer,
+                       frame: Callable[[], Tuple[List[str], str]],
+                       done: Callable[[], bool], max_fps: float = DEFAULT_MAX_FPS):
+    """
+    Draws frame() each time context.version changes, no more than max_fps
+    times a second, until done() is true. The final state is always drawn.
+    """
+    loop = asyncio.get_running_loop()
+    min_interval_s = 1.0 / max_fps
+    drawn_version = None
+    next_frame = loop.time()
+    renderer.start()
+    while True:
+        context.changed.clear()
+        if context.version != drawn_version:
+            drawn_version = context.version
+            renderer.draw(*frame())
+            next_frame = loop.time() + min_interval_s
+        if done():
+            return
+        await context.changed.wait()
+        delay_s = next_frame - loop.time()
+        if delay_s > 0 and not done():
+            await asyncio.sleep(delay_s)
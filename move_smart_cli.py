@@ -1,235 +1,397 @@
 #!/usr/bin/env python3
 
 import asyncio
-import sys
-import threading
-import time
 import json
+import signal
+import sys
 from bleak import BleakClient, BleakError
+from desk_control import (DEFAULT_KEEPALIVE_S, DEFAULT_SETTLE_QUIET_S, MotionScheduler, SETTLED,
+                          drive_until, drive_until_deadline, pulse, wait_for_height, wait_for_settle)
+from desk_dispatch import CommandDispatcher
+from desk_link import ConnectionSupervisor
+from desk_model import CoastPredictor, HeightFilter, NudgeCurve, OvershootLearner
+from desk_planner import MovePlanner
+from desk_protocol import FrameReassembler, HeightFrame
+from desk_scan import characteristic, create_bleak_client, describe_connect
+from desk_telemetry import HeightRing, RecordingClient, now_ns, open_recorder
+from desk_timing import StageTimer, report_run
+from desk_sim import SimulatedBleakClient, run_async, simulator_enabled
+from desk_ui import DEFAULT_MAX_FPS, TerminalRenderer, run_renderer
 
 # --- Configuration File Name ---
 CONFIG_FILENAME = "config.json"
 
-# --- ANSI Escape Codes ---
-CURSOR_UP_N = lambda n: f"\033[{n}F"
-CLEAR_LINE = "\033[K"
-
 class DeskContext:
     """
-    A thread-safe class to hold all shared state
-    between the UI and BLE threads.
+    Shared state for the BLE, control and UI tasks. Everything runs on one
+    asyncio loop, so no locking is needed; every change bumps `version`
+    and sets `changed` to wake the renderer. Heights live in the `heights`
+    ring buffer; current_mm is its newest sample (0 = unknown) and
+    filtered_mm the Kalman-filtered height (`motion`) that the control
+    decisions and the display use.
+    Must be created inside the running event loop.
     """
     def __init__(self, target_cm):
         self.target_mm = int(round(target_cm * 10))
-        self.current_mm = 0
         self.status = "Initializing..."
-        self.error_mm = 0
         self.is_moving = True
+        self.version = 0
         
-        self.lock = threading.Lock()
-        self.quit_event = threading.Event()
-        self.height_is_known_event = threading.Event()
+        self.reassembler = FrameReassembler()
+        self.heights = HeightRing()
+        self.motion = HeightFilter(self.heights)
+        self.changed = asyncio.Event()
+        self.quit_event = asyncio.Event()
+        self.height_is_known_event = asyncio.Event()
+        self.height_changed = asyncio.Event()
+        self.reconnect_latencies_s = []
+        self.recorder = None        # TelemetryRecorder when recording is enabled
+        self.timer = StageTimer()
+
+    def _touch(self):
+        self.version += 1
+        self.changed.set()
 
     def set_status(self, new_status):
-        with self.lock: self.status = new_status
+        self.status = new_status
+        if self.recorder is not None:
+            self.recorder.status(new_status)
+        self._touch()
+
+    @property
+    def current_mm(self):
+        return self.heights.latest_mm
 
-    def set_height(self, new_height_mm):
-        with self.lock:
-            self.current_mm = new_height_mm
-            self.error_mm = self.target_mm - self.current_mm
+    @property
+    def filtered_mm(self):
+        return self.motion.position_mm()
+
+    @property
+    def error_mm(self):
+        return self.target_mm - self.filtered_mm
+
+    def add_height(self, t_ns, height_mm):
+        """Records one height sample; wakes the renderer if the height changed."""
+        changed = height_mm != self.heights.latest_mm
+        self.heights.append(t_ns, height_mm)
+        if changed:
+            self._touch()
+
+    def clear_height(self):
+        """Marks the height unknown (e.g. while the link is down)."""
+        self.heights.reset()
+        self._touch()
+
+    def set_target(self, target_cm):
+        self.target_mm = int(round(target_cm * 10))
+        self._touch()
 
     def get_display_data(self):
-        with self.lock:
-            return (
-                self.status,
-                self.current_mm / 10.0,
-                self.target_mm / 10.0,
-                self.error_mm / 10.0
-            )
+        return (
+            self.status,
+            self.filtered_mm / 10.0,
+            self.target_mm / 10.0,
+            self.error_mm / 10.0
+        )
             
     def should_quit(self):
         return self.quit_event.is_set()
 
+    def request_quit(self, status=None):
+        if status:
+            self.set_status(status)
+        self.quit_event.set()
+        self.height_changed.set()   # Wakes anything waiting on the desk
+        self._touch()
+
 # -----------------------------------------------------------------
-# BLUETOOTH LOGIC (Runs in a separate thread)
+# BLUETOOTH LOGIC
 # -----------------------------------------------------------------
 
 def notification_handler(sender, data: bytearray, context: DeskContext):
-    hex_data = data.hex()
     try:
-        index = hex_data.index("f2f20103")
-        height_hex = hex_data[index + 8 : index + 12]
-        new_height_mm = int(height_hex, 16)
-        if new_height_mm != context.current_mm:
-            is_first_update = (context.current_mm == 0)
-            context.set_height(new_height_mm)
-            
-            if is_first_update and new_height_mm != 0:
-                context.height_is_known_event.set()
-                
-    except ValueError: pass
+        for frame in context.reassembler.feed(data):
+            if not isinstance(frame, HeightFrame): continue
+            new_height_mm = frame.height_mm
+            previous_mm = context.current_mm
+            context.add_height(now_ns(), new_height_mm)
+            if new_height_mm != previous_mm:
+                context.height_changed.set()
+                if previous_mm == 0 and new_height_mm != 0:
+                    context.height_is_known_event.set()
     except Exception as e: context.set_status(f"Parse Error: {e}")
 
 async def move_task(client: BleakClient, context: DeskContext, config: dict, commands: dict):
     """The main PID control loop"""
+    interrupted = False
+    params = config["tuning_params"]
+    motor = MotionScheduler(client, characteristic(client, config["write_uuid"]), commands["stop"],
+                            params.get("keepalive_s", DEFAULT_KEEPALIVE_S), context.timer)
     try:
         # Load parameters from config
-        params = config["tuning_params"]
-        overshoot_mm_up = params["overshoot_mm_up"]
-        overshoot_mm_down = params["overshoot_mm_down"]
         final_margin_mm = params["final_margin_mm"]
         nudge_coarse_s = params["nudge_coarse_s"]
         nudge_fine_s = params["nudge_fine_s"]
         settle_time_s = params["settle_time_s"]
+        settle_quiet_s = params.get("settle_quiet_s", DEFAULT_SETTLE_QUIET_S)
         nudge_limit = params["nudge_limit"]
-        
-        write_uuid = config["write_uuid"]
 
         context.set_status("Waiting for initial height...")
-        start_time = time.time()
-        while context.current_mm == 0:
-            if context.should_quit(): return
-            if time.time() - start_time > 10:
+        with context.timer.span("first_height"):
+            height_known = await wait_for_height(context, lambda mm: mm != 0, timeout_s=10.0)
+        if not height_known:
+            if not context.should_quit():
                 context.set_status("Error: No height data. Is desk on?")
-                return
-            await asyncio.sleep(0.1)
+            return
         
         if context.current_mm > context.target_mm:
-            direction, cmd, overshoot_mm = 'DOWN', commands["move_down"], overshoot_mm_down
-            while context.current_mm > (context.target_mm + overshoot_mm) and not context.should_quit():
-                context.set_status(f"Moving DOWN... (Compensation: {overshoot_mm}mm)")
-                await client.write_gatt_char(write_uuid, cmd, response=False)
-                await asyncio.sleep(0.1)
+            direction, cmd = 'DOWN', commands["move_down"]
         else:
-            direction, cmd, overshoot_mm = 'UP', commands["move_up"], overshoot_mm_up
-            while context.current_mm < (context.target_mm - overshoot_mm) and not context.should_quit():
-                context.set_status(f"Moving UP... (Compensation: {overshoot_mm}mm)")
-                await client.write_gatt_char(write_uuid, cmd, response=False)
-                await asyncio.sleep(0.1)
+            direction, cmd = 'UP', commands["move_up"]
+
+        learner = OvershootLearner.load(config)
+        tuning = learner.tuning(params) if learner else params
+        predictor = CoastPredictor(direction, tuning)
+        planners = {d: MovePlanner.load(config, d, tuning) for d in ("UP", "DOWN")}
+        planner = planners[direction]
+
+        if planner is not None and planner.is_short(abs(context.error_mm)):
+            # Too short to reach a speed worth re-planning from: one timed pulse.
+            drive_s = planner.drive_s(abs(context.error_mm))
+            context.set_status(f"Moving {direction}... (Planned pulse {drive_s * 1000:.0f}ms)")
+            with context.timer.span("fast_approach"):
+                await pulse(motor, cmd, drive_s)
+        elif planner is not None:
+            # Stop at the planned moment, re-planned on every height notification.
+            context.set_status(f"Moving {direction}... (Planned stop)")
+            with context.timer.span("fast_approach"):
+                await drive_until_deadline(motor, context, cmd, planner.deadline(context, asyncio.get_running_loop()))
+        else:
+            # Stop once the predicted resting point (height + live coast estimate) reaches the target.
+            reached = lambda mm: predictor.should_stop(context.filtered_mm, context.motion.velocity(), context.target_mm)
+            if predictor.decel_mm_s2:
+                context.set_status(f"Moving {direction}... (Predictive stop)")
+            else:
+                context.set_status(f"Moving {direction}... (Compensation: {round(predictor.overshoot_at(context.target_mm), 1):g}mm)")
+
+            # Wakes on every height notification; the move command is refreshed on its own timer.
+            with context.timer.span("fast_approach"):
+                await drive_until(motor, context, cmd, reached)
         
         if context.should_quit(): return
         
         context.set_status(f"Fast approach complete. Stopping...")
-        await client.write_gatt_char(write_uuid, commands["stop"], response=False)
-        await asyncio.sleep(0.1)
-        await client.write_gatt_char(write_uuid, commands["stop"], response=False)
+        stop_mm, stop_speed_mm_s = context.filtered_mm, abs(context.motion.velocity())
+        with context.timer.span("stop"):
+            await motor.stop()
+            await asyncio.sleep(0.1)
+            await motor.stop()
+
+        context.set_status("Waiting to settle...")
+        with context.timer.span("settle"):
+            settled = await wait_for_settle(context, settle_quiet_s, settle_time_s)
+
+        # The settled height shows how far the desk really coasted after stop;
+        # after a timeout it was still moving, so there is nothing to learn.
+        if settled == SETTLED and learner is not None:
+            coast_mm = context.filtered_mm - stop_mm if direction == 'UP' else stop_mm - context.filtered_mm
+            # The predictor looks its tables up at the target, so learn at the same height.
+            if learner.observe(predictor, stop_speed_mm_s, coast_mm, context.target_mm):
+                learner.save()
         
+        # With a calibrated curve (or else the motor model), one pulse is sized to the whole residual.
+        nudge_curves = {"UP": NudgeCurve.load(params, "UP"), "DOWN": NudgeCurve.load(params, "DOWN")}
         nudge_count = 0
-        while abs(context.error_mm) > final_margin_mm and nudge_count < nudge_limit and not context.should_quit():
+        while settled and abs(round(context.error_mm)) > final_margin_mm and nudge_count < nudge_limit and not context.should_quit():
             nudge_count += 1
-            context.set_status(f"Waiting to settle... (Nudge {nudge_count}/{nudge_limit})")
-            await asyncio.sleep(settle_time_s)
-            
-            error_mm = context.error_mm
-            if abs(error_mm) <= final_margin_mm: break
+            error_mm = round(context.error_mm)
+            nudge_direction = "UP" if error_mm > 0 else "DOWN"
+            curve = nudge_curves[nudge_direction]
+            if curve is not None:
+                nudge_duration_s = curve.pulse_s(error_mm)
+                status_detail = f"{nudge_duration_s * 1000:.0f}ms for {abs(error_mm)}mm"
+            elif planners[nudge_direction] is not None:
+                nudge_duration_s = planners[nudge_direction].drive_s(abs(error_mm))
+                status_detail = f"Planned {nudge_duration_s * 1000:.0f}ms for {abs(error_mm)}mm"
+            else:
+                nudge_duration_s = nudge_fine_s if abs(error_mm) <= 5 else nudge_coarse_s
+                status_detail = "Fine 50ms" if nudge_duration_s == nudge_fine_s else "Coarse 100ms"
 
-            nudge_duration_s = nudge_fine_s if abs(error_mm) <= 5 else nudge_coarse_s
-            status_detail = "Fine 50ms" if nudge_duration_s == nudge_fine_s else "Coarse 100ms"
+            with context.timer.span("nudge"):
+                context.set_status(f"Nudging {nudge_direction}... ({status_detail})")
+                cmd = commands["move_up"] if nudge_direction == "UP" else commands["move_down"]
+                await pulse(motor, cmd, nudge_duration_s)
 
-            if error_mm > 0:
-                context.set_status(f"Nudging UP... ({status_detail})")
-                await client.write_gatt_char(write_uuid, commands["move_up"], response=False)
-            else:
-                context.set_status(f"Nudging DOWN... ({status_detail})")
-                await client.write_gatt_char(write_uuid, commands["move_down"], response=False)
-            
-            await asyncio.sleep(nudge_duration_s)
-            await client.write_gatt_char(write_uuid, commands["stop"], response=False)
+            context.set_status(f"Waiting to settle... (Nudge {nudge_count}/{nudge_limit})")
+            with context.timer.span("settle"):
+                settled = await wait_for_settle(context, settle_quiet_s, settle_time_s)
 
         context.set_status("Target height reached. Complete.")
         
+    except asyncio.CancelledError:
+        interrupted = True
+        raise
     except Exception as e:
+        if not client.is_connected:
+            # Link lost: let the connection supervisor resume the move.
+            interrupted = True
+            raise
         context.set_status(f"Error in move_task: {e}")
     finally:
         context.is_moving = False
-        await client.write_gatt_char(config["write_uuid"], commands["stop"], response=False)
-        context.quit_event.set()
+        # Stop first: closing the scheduler only ends the refreshes.
+        try:
+            if client.is_connected:
+                await motor.stop(emergency=True)
+        finally:
+            await motor.close()
+        if not interrupted:
+            context.request_quit()
 
-async def async_ble_main(context: DeskContext, config: dict, commands: dict):
-    client = None
-    try:
-        device_address = config["device_address"]
-        write_uuid = config["write_uuid"]
-        notify_uuid = config["notify_uuid"]
+def create_client(config: dict, disconnected_callback=None, recorder=None, timer=None):
+    """
+    BleakClient for the configured desk (through the scan cache), or the
+    simulator if enabled; recorded if a recorder is given, and writing through a CommandDispatcher.
+    """
+    if simulator_enabled(config):
+        client = SimulatedBleakClient(config, disconnected_callback=disconnected_callback)
+    else:
+        client = create_bleak_client(config, disconnected_callback)
+    if recorder is not None:
+        client = RecordingClient(client, recorder)
+    return CommandDispatcher(client, config, timer)
 
-        context.set_status(f"Scanning for {device_address}...")
-        client = BleakClient(device_address)
+async def connect_desk(client, context: DeskContext, config: dict, commands: dict):
+    """Connects, wakes the desk, subscribes to height notifications and requests a reading."""
+    timer = context.timer
+    context.set_status(f"Scanning for {config['device_address']}...")
+    with timer.span("connect"):
         await client.connect(timeout=10.0)
-        context.set_status("Connected. Waking desk...")
+    context.set_status(f"Connected{describe_connect(client)}. Waking desk...")
+    write_char = characteristic(client, config["write_uuid"])
+    notify_char = characteristic(client, config["notify_uuid"])
 
-        await client.write_gatt_char(write_uuid, commands["stop"], response=False)
+    with timer.span("wake"):
+        await client.write_gatt_char(write_char, commands["stop"], response=False)
         await asyncio.sleep(0.2)
 
-        context.set_status("Starting height listener...")
+    context.set_status("Starting height listener...")
+    with timer.span("subscribe"):
         await client.start_notify(
-            notify_uuid,
+            notify_char,
             lambda sender, data: notification_handler(sender, data, context)
         )
-        
-        context.set_status("Reading current height...")
-        await client.write_gatt_char(write_uuid, commands["fetch_height"], response=False)
+    
+    context.set_status("Reading current height...")
+    with timer.span("request_height"):
+        await client.write_gatt_char(write_char, commands["fetch_height"], response=False)
         await asyncio.sleep(0.1)
-        await client.write_gatt_char(write_uuid, commands["fetch_height"], response=False)
-        
-        await move_task(client, context, config, commands)
+        await client.write_gatt_char(write_char, commands["fetch_height"], response=False)
+
+def create_supervisor(context: DeskContext, config: dict, commands: dict) -> ConnectionSupervisor:
+    """Connection supervisor that reconnects and re-runs connect_desk after a link loss."""
+    return ConnectionSupervisor(
+        context,
+        lambda on_disconnect: create_client(config, on_disconnect, context.recorder, context.timer),
+        lambda client: connect_desk(client, context, config, commands),
+        config.get("reconnect"),
+    )
+
+async def async_ble_main(context: DeskContext, config: dict, commands: dict):
+    supervisor = None
+    try:
+        supervisor = create_supervisor(context, config, commands)
+        context.reconnect_latencies_s = supervisor.reconnect_latencies_s
+        with context.timer.span("total"):
+            await supervisor.start()
+            await supervisor.run(lambda: move_task(supervisor.client, context, config, commands))
         
-        while not context.should_quit():
-             await asyncio.sleep(0.1)
+        await context.quit_event.wait()
              
     except BleakError as e:
         context.set_status(f"BleakError: {e}")
     except Exception as e:
         context.set_status(f"Error: {e}")
     finally:
-        if client and client.is_connected:
-            context.set_status("Disconnecting...")
-            await client.stop_notify(config["notify_uuid"])
-            await client.disconnect()
+        if supervisor:
+            await supervisor.close()
+            client = supervisor.client
+            if client.is_connected:
+                context.set_status("Disconnecting...")
+                await client.stop_notify(config["notify_uuid"])
+                await client.disconnect()
         context.set_status("Disconnected.")
         context.is_moving = False
-        context.quit_event.set()
-
-def run_ble_logic(context: DeskContext, config: dict, commands: dict):
-    try:
-        asyncio.run(async_ble_main(context, config, commands))
-    except Exception as e:
-        context.set_status(f"BLE Thread Error: {e}")
+        context.request_quit()
 
 # -----------------------------------------------------------------
-# ASCII UI LOGIC (Runs in the Main thread)
+# ASCII UI LOGIC
 # -----------------------------------------------------------------
 
-def draw_ascii_ui(context: DeskContext, ble_thread: threading.Thread):
+async def draw_ascii_ui(context: DeskContext, ble_task: asyncio.Task, max_fps: float = DEFAULT_MAX_FPS):
     """
-    Main UI loop for the regular terminal.
+    Renderer task for the terminal. Redraws only the lines that changed,
+    only when the context reports a change, and at most max_fps times a
+    second; logs one line per change when stdout is not a terminal.
     """
-    UI_LINES = 8
-    print("\n" * UI_LINES)
-    
+    def frame():
+        status, current_cm, target_cm, error_cm = context.get_display_data()
+        lines = [
+            "--- Desk Controller ---",
+            "",
+            f"  Target:  {target_cm:.1f} cm",
+            f"  Current: {current_cm:.1f} cm",
+            f"  Error:   {error_cm:.1f} cm",
+            "",
+            f"  Status: {status}",
+            "  (Press Ctrl+C to quit)",
+        ]
+        return lines, f"{current_cm:.1f} cm (target {target_cm:.1f}, error {error_cm:+.1f}) {status}"
+
+    renderer = TerminalRenderer(8)
     try:
-        while not context.should_quit():
-            status, current_cm, target_cm, error_cm = context.get_display_data()
-            ui_string = (
-                f"--- Desk Controller ---{CLEAR_LINE}\n"
-                f"{CLEAR_LINE}\n"
-                f"  Target:  {target_cm:.1f} cm{CLEAR_LINE}\n"
-                f"  Current: {current_cm:.1f} cm{CLEAR_LINE}\n"
-                f"  Error:   {error_cm:.1f} cm  {CLEAR_LINE}\n"
-                f"{CLEAR_LINE}\n"
-                f"  Status: {status}{CLEAR_LINE}\n"
-                f"  (Press Ctrl+C to quit){CLEAR_LINE}\n"
-            )
-            print(CURSOR_UP_N(UI_LINES), end="")
-            print(ui_string, end="")
-            time.sleep(0.05)
-    except KeyboardInterrupt:
-        context.set_status("Manual quit... disconnecting...")
-        context.quit_event.set()
+        await run_renderer(context, renderer, frame, context.should_quit, max_fps)
     finally:
-        ble_thread.join()
-        print(CURSOR_UP_N(UI_LINES), end="")
-        for _ in range(UI_LINES): print(f"{CLEAR_LINE}")
+        await ble_task
+        renderer.close()
         print("Disconnected. Exiting.")
+        if context.reconnect_latencies_s:
+            latencies = context.reconnect_latencies_s
+            print(f"Reconnected {len(latencies)} time(s), avg {sum(latencies) / len(latencies):.2f} s, max {max(latencies):.2f} s.")
+        link = context.reassembler
+        if link.dropped_bytes or link.corrupt_frames:
+            print(f"Warning: {link.corrupt_frames} corrupt frames, {link.dropped_bytes} bytes dropped on the notify link.")
+
+async def async_main(target_height_cm: float, config: dict, commands: dict) -> int:
+    """Runs the BLE/control task and the renderer on one event loop. Returns the exit code."""
+    context = DeskContext(target_height_cm)
+    context.recorder = open_recorder(config, "move_smart_cli.py")
+    if context.recorder is not None:
+        context.recorder.move(context.target_mm)
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGINT, context.request_quit, "Manual quit... disconnecting...")
+    try:
+        ble_task = asyncio.create_task(async_ble_main(context, config, commands))
+        
+        print(f"Connecting to {config['device_address']} and reading initial height...")
+        
+        height_known = asyncio.create_task(context.height_is_known_event.wait())
+        await asyncio.wait({height_known, ble_task}, timeout=10.0, return_when=asyncio.FIRST_COMPLETED)
+        height_known.cancel()
+        if not context.height_is_known_event.is_set():
+            print("Error: Could not connect or read initial height from desk.")
+            print("Make sure it's on and not connected to another device.")
+            context.request_quit()
+            await ble_task
+            return 1
+        
+        await draw_ascii_ui(context, ble_task, config.get("ui", {}).get("max_fps", DEFAULT_MAX_FPS))
+        return 0
+    finally:
+        report_run(context.timer, config)
+        if context.recorder is not None:
+            context.recorder.close()
+            print(f"Telemetry appended to {context.recorder.path}")
 
 # -----------------------------------------------------------------
 # MAIN FUNCTION
@@ -237,7 +399,7 @@ def draw_ascii_ui(context: DeskContext, ble_thread: threading.Thread):
 
 def main():
     """
-    Main entry point: loads config, validates input, and starts threads.
+    Main entry point: loads config, validates input, and starts the event loop.
     """
     # --- Argument Parsing ---
     if len(sys.argv) != 2:
@@ -284,25 +446,24 @@ def main():
         print(f"Error converting commands in config file: {e}")
         sys.exit(1)
         
-    # --- Start Application ---
-    context = DeskContext(target_height_cm)
-    
-    ble_thread = threading.Thread(
-        target=run_ble_logic, 
-        args=(context, config, commands_bytes)
-    )
-    ble_thread.start()
-    
-    print(f"Connecting to {config['device_address']} and reading initial height...")
-    
-    if not context.height_is_known_event.wait(timeout=10.0):
-        print("Error: Could not connect or read initial height from desk.")
-        print("Make sure it's on and not connected to another device.")
-        context.quit_event.set()
-        ble_thread.join()
+    # --- Hand Off to the Daemon if One Is Running ---
+    from desk_daemon import send_request
+    try:
+        reply = send_request(config, {"cmd": "move", "target_cm": target_height_cm})
+    except (FileNotFoundError, ConnectionRefusedError):
+        reply = None
+    except Exception as e:
+        print(f"Error talking to desk daemon: {e}")
         sys.exit(1)
-    
-    draw_ascii_ui(context, ble_thread)
+    if reply is not None:
+        if not reply.get("ok"):
+            print(f"Daemon error: {reply.get('error')}")
+            sys.exit(1)
+        print(f"Daemon: moving from {reply['height_cm']:.1f} cm to {reply['target_cm']:.1f} cm.")
+        sys.exit(0)
+
+    # --- Start Application ---
+    sys.exit(run_async(async_main(target_height_cm, config, commands_bytes), config))
 
 if __name__ == "__main__":
     main()
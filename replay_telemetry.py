@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Replays a session recorded by the telemetry recorder (see desk_telemetry.py).
+
+Every session is fed back through the frame parser. If the session
+contains a move, the recorded notifications are also played into the
+current move_task on a virtual clock, and the command writes it makes are
+compared with the ones recorded on the desk. Run it after changing the
+controller or config.json to see whether a recorded move would now go
+differently.
+
+Usage: python3 replay_telemetry.py <log_file> [session_index]
+       (session_index defaults to the last session, negative counts from the end)
+"""
+
+import asyncio
+import json
+import sys
+import time
+
+from desk_control import wait_for_height
+from desk_dispatch import CommandDispatcher
+from desk_protocol import FrameReassembler, HeightFrame
+from desk_sim import run_virtual
+from desk_telemetry import (REC_MOVE, REC_NOTIFY, REC_STATUS, REC_WRITE, move_target_mm,
+                            read_records, split_sessions)
+from move_smart_cli import CONFIG_FILENAME, DeskContext, connect_desk, move_task
+
+# How long move_task may keep going after the last recorded notification.
+REPLAY_GRACE_S = 5.0
+
+
+class ReplayClient:
+    """BleakClient stand-in that plays recorded notifications and records writes."""
+    def __init__(self, notifications):
+        self.notifications = notifications      # [(offset_s, bytes)]
+        self.writes = []                        # [(offset_s, bytes)]
+        self.is_connected = False
+        self.feeder = None
+        self._start = 0.0
+
+    async def connect(self, timeout: float = 10.0, **kwargs):
+        self._start = asyncio.get_running_loop().time()
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        if self.feeder is not None:
+            self.feeder.cancel()
+        return True
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self.feeder = asyncio.create_task(self._feed(char_specifier, callback))
+
+    async def stop_notify(self, char_specifier):
+        if self.feeder is not None:
+            self.feeder.cancel()
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        self.writes.append((asyncio.get_running_loop().time() - self._start, bytes(data)))
+
+    async def _feed(self, char_specifier, callback):
+        loop = asyncio.get_running_loop()
+        for offset_s, data in self.notifications:
+            delay_s = self._start + offset_s - loop.time()
+            if delay_s > 0:
+                await asyncio.sleep(delay_s)
+            callback(char_specifier, bytearray(data))
+
+
+def relative(session, kind):
+    """(seconds since session start, payload) for every record of one kind."""
+    t0 = session[0].t_ns
+    return [((r.t_ns - t0) / 1e9, r.payload) for r in session if r.kind == kind]
+
+
+def command_runs(writes, names):
+    """Collapses repeated writes, e.g. a keepalive, into [name, count, first_offset_s] runs."""
+    runs = []
+    for offset_s, data in writes:
+        name = names.get(data, data.hex())
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1, offset_s])
+    return runs
+
+
+def replay_parser(session):
+    """Feeds the recorded notifications through a fresh reassembler."""
+    reassembler = FrameReassembler()
+    heights = []
+    for _, data in relative(session, REC_NOTIFY):
+        heights.extend(f.height_mm for f in reassembler.feed(data) if isinstance(f, HeightFrame))
+    print(f"  Parser:   {len(heights)} height frames, {reassembler.corrupt_frames} corrupt, "
+          f"{reassembler.dropped_bytes} bytes dropped")
+    if heights:
+        print(f"  Heights:  {heights[0] / 10.0:.1f} -> {heights[-1] / 10.0:.1f} cm "
+              f"(range {min(heights) / 10.0:.1f}-{max(heights) / 10.0:.1f} cm)")
+
+
+async def replay_move(session, target_mm, config: dict, commands: dict):
+    context = DeskContext(target_mm / 10.0)
+    client = CommandDispatcher(ReplayClient(relative(session, REC_NOTIFY)), config)
+    await connect_desk(client, context, config, commands)
+    if await wait_for_height(context, lambda mm: mm != 0, timeout_s=10.0):
+        move = asyncio.create_task(move_task(client, context, config, commands))
+        await asyncio.wait({move, client.feeder}, return_when=asyncio.FIRST_COMPLETED)
+        if not move.done():
+            await asyncio.wait({move}, timeout=REPLAY_GRACE_S)
+        if not move.done():
+            context.request_quit("Replay ended before the move finished.")
+            await move
+    await client.disconnect()
+    return context, client
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("Error: Invalid arguments.")
+        print(f"Usage: python3 {sys.argv[0]} <log_file> [session_index]")
+        sys.exit(1)
+
+    try:
+        with open(CONFIG_FILENAME, 'r') as f:
+            config = json.load(f)
+        commands = {name: bytes.fromhex(cmd) for name, cmd in config["commands"].items()}
+    except Exception as e:
+        print(f"Error loading '{CONFIG_FILENAME}': {e}")
+        sys.exit(1)
+    # A replay must not teach the live desk's learned state anything.
+    config["learning"] = dict(config.get("learning", {}), enabled=False)
+
+    try:
+        sessions = split_sessions(read_records(sys.argv[1]))
+    except (OSError, ValueError) as e:
+        print(f"Error reading telemetry log: {e}")
+        sys.exit(1)
+    if not sessions:
+        print("The log contains no sessions.")
+        sys.exit(1)
+
+    try:
+        index = int(sys.argv[2]) if len(sys.argv) == 3 else -1
+        session = sessions[index]
+    except (ValueError, IndexError):
+        print(f"Error: session index must be between {-len(sessions)} and {len(sessions) - 1}.")
+        sys.exit(1)
+
+    duration_s = (session[-1].t_ns - session[0].t_ns) / 1e9
+    statuses = relative(session, REC_STATUS)
+    print(f"Session {index % len(sessions)} ({len(sessions)} in log): {session[0].payload.decode(errors='replace')}")
+    print(f"  Duration: {duration_s:.2f} s, {len(relative(session, REC_NOTIFY))} notifications, "
+          f"{len(relative(session, REC_WRITE))} writes, {len(statuses)} status changes")
+    replay_parser(session)
+    for offset_s, text in statuses:
+        print(f"  {offset_s:8.3f} s  {text.decode(errors='replace')}")
+
+    moves = [r for r in session if r.kind == REC_MOVE]
+    if not moves:
+        return
+    if len(moves) > 1:
+        print(f"\nSession has {len(moves)} moves; replaying the first.")
+    target_mm = move_target_mm(moves[0])
+
+    started = time.perf_counter()
+    context, client = run_virtual(replay_move(session, target_mm, config, commands))
+    elapsed_s = time.perf_counter() - started
+
+    names = {data: name for name, data in commands.items()}
+    recorded = command_runs(relative(session, REC_WRITE), names)
+    replayed = command_runs(client.writes, names)
+    print(f"\n--- Controller Replay (target {target_mm / 10.0:.1f} cm, {elapsed_s:.3f} s wall) ---")
+    print(f"  Final status: {context.status}")
+    print(f"  Final height: {context.current_mm / 10.0:.1f} cm (error {context.error_mm / 10.0:+.1f} cm)")
+    print(f"  Writes: {len(relative(session, REC_WRITE))} recorded, {len(client.writes)} replayed")
+    print(f"  {'Recorded':<30}{'Replayed':<30}")
+    diverged = None
+    for i in range(max(len(recorded), len(replayed))):
+        left = f"{recorded[i][2]:7.3f} s {recorded[i][0]} x{recorded[i][1]}" if i < len(recorded) else ""
+        right = f"{replayed[i][2]:7.3f} s {replayed[i][0]} x{replayed[i][1]}" if i < len(replayed) else ""
+        same = i < len(recorded) and i < len(replayed) and recorded[i][0] == replayed[i][0]
+        if not same and diverged is None:
+            diverged = i
+        print(f"  {left:<30}{right:<30}{'' if same else '  <-'}")
+    if diverged is None:
+        print("  The replayed command sequence matches the recording.")
+    else:
+        print(f"  Command sequences diverge at step {diverged + 1}.")
+
+
+if __name__ == "__main__":
+    main()